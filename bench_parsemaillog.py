@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+import parsemaillog
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description='Compare the old split-every-line mail.log parser with '
+                    'parsemaillog.parse_file over a synthetic log')
+    ap.add_argument('-s', '--size', type=int, default=256, help='log size in MB')
+    ap.add_argument('-i', '--iso', action='store_true', help='ISO8601 stamps instead of syslog ones')
+    ap.add_argument('-k', '--keep', help='write the log here and keep it')
+    ap.add_argument('-l', '--legacy', action='store_true', help='also time the old parser, and check results match')
+    return ap.parse_args()
+
+
+def getfield(parts, name, stripchars='<>'):
+    try:
+        field = [i for i in parts if i.startswith(f'{name}=')][0]
+        field = field.split('=')[1]
+        field = field.strip(stripchars)
+        return field
+    except IndexError:
+        return None
+
+
+def legacy_parse_file(name, msgs):
+    # what parsemaillog.main() used to do for each file
+    f = open(name, 'r')
+    mtime = os.fstat(f.fileno()).st_mtime
+    dt_mtime = datetime.datetime.fromtimestamp(mtime)
+    fileyear = dt_mtime.year
+    for line in f:
+        parts = line.split()
+        parts = [p.strip(' ,') for p in parts]
+        try:
+            dtval=datetime.datetime.fromisoformat(parts[0])
+            dtval=dtval.replace(tzinfo=None)
+            parts = parts[1:]
+        except ValueError:
+            dt_parts = parts[0:3]
+            parts = parts[3:]
+            dtval=datetime.datetime.strptime(
+                ' '.join(dt_parts) + ' ' + str(fileyear),'%b %d %H:%M:%S %Y')
+        parts = parts[2:]
+
+        to = getfield(parts, 'to')
+        messageid = getfield(parts, 'message-id')
+        fr = getfield(parts, 'from')
+        orig_to = getfield(parts, 'orig_to')
+        status = getfield(parts, 'status')
+
+        if to or messageid or fr or orig_to:
+            qid = parts.pop(0).rstrip(':')
+            md = msgs[qid]
+            md['origline'] = line.strip()
+            md['dt'] = dtval
+            md['status'] = status
+        if to:
+            md['to'].append(to)
+        if messageid:
+            md['msgid'] = messageid
+        if fr:
+            md['fr'] = fr
+        if orig_to:
+            md['orig_to'] = orig_to
+    f.close()
+    return msgs
+
+
+def write_log(f, size, iso):
+    # a postfix-ish mix: mostly connection chatter, some queue id lines
+    rnd = random.Random(0)
+    dt = datetime.datetime(2024, 1, 1)
+    users = [f'user{i}@example.com' for i in range(200)]
+    lists = [f'list{i}@example.org' for i in range(20)]
+    written = qn = 0
+    while written < size:
+        dt += datetime.timedelta(microseconds=rnd.randrange(200000))
+        if iso:
+            stamp = dt.isoformat(timespec='microseconds') + '+00:00'
+        else:
+            stamp = dt.strftime('%b %d %H:%M:%S').replace(' 0', '  ')
+        qn += 1
+        qid = f'{qn:010X}'
+        pid = rnd.randrange(1000, 99999)
+        ip = f'10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}'
+        lines = [
+            f'{stamp} mail postfix/smtpd[{pid}]: connect from unknown[{ip}]',
+            f'{stamp} mail postfix/smtpd[{pid}]: {qid}: client=unknown[{ip}]',
+            f'{stamp} mail postfix/cleanup[{pid}]: {qid}: message-id=<{qn}.{rnd.random()}@example.com>',
+            f'{stamp} mail postfix/qmgr[{pid}]: {qid}: from=<{rnd.choice(users)}>, size={rnd.randrange(100000)}, nrcpt=3 (queue active)',
+            f'{stamp} mail postfix/smtpd[{pid}]: disconnect from unknown[{ip}] ehlo=1 mail=1 rcpt=1 data=1 quit=1 commands=5',
+        ]
+        dest = rnd.choice(lists)
+        for to in rnd.sample(users, 3):
+            lines.append(
+                f'{stamp} mail postfix/smtp[{pid}]: {qid}: to=<{to}>, orig_to=<{dest}>, relay=mx.example.com[{ip}]:25, '
+                f'delay=0.5, delays=0.1/0/0.2/0.2, dsn=2.0.0, status=sent (250 2.0.0 OK {qn})')
+        lines.append(f'{stamp} mail postfix/qmgr[{pid}]: {qid}: removed')
+        lines.extend(f'{stamp} mail dovecot: imap(user{i}): Logged out in=120 out=3456' for i in range(rnd.randrange(8)))
+        text = '\n'.join(lines) + '\n'
+        f.write(text)
+        written += len(text)
+
+
+def bench(name, fn, path, size):
+    start = time.perf_counter()
+    msgs = fn(path, parsemaillog.new_msgs())
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {elapsed:8.3f}s {size / elapsed / 2**20:8.1f} MB/s {len(msgs)} queue ids')
+    return elapsed, msgs
+
+
+def main():
+    args = parse_args()
+    size = args.size * 2**20
+
+    if args.keep:
+        path = args.keep
+        f = open(path, 'w')
+    else:
+        f = tempfile.NamedTemporaryFile('w', suffix='.log', delete=False)
+        path = f.name
+    try:
+        with f:
+            write_log(f, size, args.iso)
+        size = os.path.getsize(path)
+        print(f'{path}: {size / 2**20:.0f} MB')
+
+        new, newresult = bench('parse_file', parsemaillog.parse_file, path, size)
+        if args.legacy:
+            old, oldresult = bench('legacy', legacy_parse_file, path, size)
+            if oldresult != newresult:
+                print('MISMATCH between parsers', file=sys.stderr)
+                return 1
+            print(f'{"speedup":>10}: {old / new:8.1f}x')
+    finally:
+        if not args.keep:
+            os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
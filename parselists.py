@@ -1,99 +1,222 @@
 #!/usr/bin/env python3
 import argparse
 import csv
-import difflib
 import email
 import hashlib
+import json
+import os
 import requests
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 VENUE_TO_CSVURL = {
     'lcl': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQ-Wh4Xd7n7wuBb0gnOpmoO2GFwTpvXEK0fcXd1dwF8GOrhV7z8vQXjGPKE5Is3UgMNeDOGSqwGmHR2/pub?gid=0&single=true&output=csv',
     'gl': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQ-Wh4Xd7n7wuBb0gnOpmoO2GFwTpvXEK0fcXd1dwF8GOrhV7z8vQXjGPKE5Is3UgMNeDOGSqwGmHR2/pub?gid=1132700691&single=true&output=csv',
 }
 
+# validators and checksum from the last fetch, per venue
+STATE_FILE = 'parselists.{venue}.json'
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('-d', '--debug', action='store_true')
     ap.add_argument('-V', '--venue', default='lcl', choices=VENUE_TO_CSVURL.keys())
+    ap.add_argument('-a', '--all', action='store_true', help='all venues at once')
+    ap.add_argument('-m', '--map', help='also write every list fetched, as listname.venue, to this postmap(1) source file')
     return ap.parse_args()
 
-def main():
-
-    args = parse_args()
-
-    venue = args.venue
-    musicians = requests.get(VENUE_TO_CSVURL[venue])
-    oldmusicians = ''
-
-    length = len([l for l in musicians.iter_lines(decode_unicode=True)])
-
-    if (length < 10) or (length > 1000):
-        print(f'Apparently bad fetch {venue} musicians list: len {length}')
-        print('response.text:\n', musicians.text)
-        exit(1)
-
-    all_musicians = csv.reader(musicians.iter_lines(decode_unicode=True))
-
-    # don't do contents comparison in debug mode
-    if not args.debug:
-        try:
-            with open(f'all_musicians.{venue}.csv', 'rb') as f:
-                oldmusicians = f.read()
-            h = hashlib.sha256()
-            h.update(oldmusicians)
-            old_checksum = h.digest()
-            h = hashlib.sha256()
-            h.update(musicians.content)
-            new_checksum = h.digest()
-            if old_checksum == new_checksum:
-                return(1)
-        except FileNotFoundError as e:
-            pass
-
-    with open(f'all_musicians.{venue}.csv', 'w') as f:
-        f.write(musicians.text)
-
-    oldlines = oldmusicians.decode().split('\r\n')
-    newlines = musicians.text.split('\r\n')
-    difflines = list(difflib.unified_diff(oldlines, newlines))
-    print('\n'.join(difflines[4:]))
-    print()
-
-    all_musicians = csv.reader(musicians.iter_lines(decode_unicode=True))
-
-    out_file = None
+def load_state(venue):
+    try:
+        with open(STATE_FILE.format(venue=venue)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    # first run: the checksum of what we fetched last is still useful
+    try:
+        with open(f'all_musicians.{venue}.csv', 'rb') as f:
+            return dict(sha256=hashlib.sha256(f.read()).hexdigest())
+    except FileNotFoundError:
+        return dict()
+
+def write_atomic(path, text):
+    # readers (postfix, via the aliases) see the old file or the new one
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+def save_state(venue, state):
+    write_atomic(STATE_FILE.format(venue=venue), json.dumps(state))
+
+def read_list(path):
+    try:
+        with open(path) as f:
+            return [l for l in f.read().split('\n') if l]
+    except FileNotFoundError:
+        return list()
+
+def conditional_headers(state):
+    headers = dict()
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+def read_lines(response, h, raw):
+    # decoded lines of the body, hashing and keeping the bytes as they go by
+    pending = b''
+    for chunk in response.iter_content(chunk_size=16384):
+        h.update(chunk)
+        raw.append(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r').decode()
+    if pending:
+        yield pending.rstrip(b'\r').decode()
+
+def parse_lists(lines, debug=False):
+    # (line count, {list name: [addresses]}, {list name: [skip messages]})
+    length = 0
+    mlists = dict()
+    skipped = dict()
     mlistname = ''
     mlist = list()
 
-    for musician in all_musicians:
-        if args.debug:
+    def counted(lines):
+        nonlocal length
+        for line in lines:
+            length += 1
+            yield line
+
+    for musician in csv.reader(counted(lines)):
+        if debug:
             print('>>>', mlistname, musician)
         if len(musician) < 2:
             continue
         if len(musician[0]):
-            if mlistname:
-                if args.debug:
-                    print(f'\n{mlistname}:\n', '\n'.join(mlist), sep='')
-                else:
-                    with open(f'{mlistname}.{venue}.txt', 'w') as out_file:
-                        print('\n'.join(mlist), file=out_file)
             mlistname = musician[0]
-            mlist = list()
+            mlist = mlists[mlistname] = list()
+        if not musician[1]:
+            # a blank row
+            continue
         if len(musician) > 2 and 'skip' in musician[2].lower():
-            print(f'{mlistname} {musician[1]}: {musician[2]}')
+            skipped.setdefault(mlistname, list()).append(f'{musician[1]}: {musician[2]}')
             continue
-        try:
-            mlist.append(musician[1])
-        except KeyError:
-            print(f'Failed to parse ${musician[1]}')
-            pass
+        mlist.append(musician[1])
+
+    return length, mlists, skipped
+
+class BadFetch(Exception):
+    pass
+
+def update_venue(session, venue, debug=False):
+    # Fetch venue's sheet if it changed and rewrite its changed lists.
+    # Returns (names of changed lists, {list name: [addresses]}, report
+    # lines); the lists come from the state file when the sheet hasn't
+    # changed.
+    # don't do contents comparison in debug mode
+    state = dict() if debug else load_state(venue)
+    # a 304 is only useful if we saved the lists it means are unchanged
+    headers = conditional_headers(state) if 'lists' in state else dict()
+    musicians = session.get(VENUE_TO_CSVURL[venue], headers=headers, stream=True)
+    if musicians.status_code == 304:
+        return list(), state['lists'], list()
+
+    h = hashlib.sha256()
+    raw = list()
+    length, mlists, skipped = parse_lists(read_lines(musicians, h, raw), debug)
+    content = b''.join(raw)
+    text = content.decode()
+
+    if (length < 10) or (length > 1000):
+        raise BadFetch(f'Apparently bad fetch {venue} musicians list: len {length}\n'
+                       f'response.text:\n {text}')
+
+    newstate = dict(
+        etag=musicians.headers.get('ETag'),
+        last_modified=musicians.headers.get('Last-Modified'),
+        sha256=h.hexdigest(),
+        lists=mlists,
+    )
+    if not debug and state.get('sha256') == newstate['sha256']:
+        save_state(venue, newstate)
+        return list(), mlists, list()
+
+    write_atomic(f'all_musicians.{venue}.csv', text)
+
+    # only lists whose membership changed are rewritten (order doesn't
+    # matter to an alias)
+    changed = list()
+    report = list()
+    for mlistname, mlist in mlists.items():
+        if debug:
+            report.append(f'\n{mlistname}:\n' + '\n'.join(mlist))
+            continue
+        path = f'{mlistname}.{venue}.txt'
+        old = set(read_list(path))
+        added = [a for a in mlist if a not in old]
+        removed = sorted(old - set(mlist))
+        if added or removed:
+            write_atomic(path, '\n'.join(mlist) + '\n')
+            changed.append(mlistname)
+            report.append(f'{mlistname}:')
+            report.extend(f'  + {address}' for address in added)
+            report.extend(f'  - {address}' for address in removed)
+            report.extend(f'  skipped {line}' for line in skipped.get(mlistname, []))
+
+    if not debug:
+        save_state(venue, newstate)
+    return changed, mlists, report
+
+def format_map(venue_lists):
+    # postmap(1) source: "listname.venue address, address" for every
+    # (venue, lists), the names of the per-venue list files; venues
+    # sharing a list name stay separate lists
+    lines = list()
+    for venue, mlists in venue_lists:
+        for mlistname, mlist in mlists.items():
+            if mlist:
+                lines.append(f'{mlistname}.{venue}\t{", ".join(dict.fromkeys(mlist))}')
+    return '\n'.join(sorted(lines)) + '\n'
+
+def main():
 
+    args = parse_args()
+
+    venues = list(VENUE_TO_CSVURL) if args.all else [args.venue]
+    with requests.Session() as session:
+        with ThreadPoolExecutor(max_workers=len(venues)) as pool:
+            futures = [pool.submit(update_venue, session, venue, args.debug) for venue in venues]
+            try:
+                results = [f.result() for f in futures]
+            except BadFetch as e:
+                print(e)
+                exit(1)
+
+    changed = list()
+    for changed_lists, _, report in results:
+        changed.extend(changed_lists)
+        for line in report:
+            print(line)
     if args.debug:
-        print(f'\n{mlistname}:\n', '\n'.join(mlist), sep='')
+        return
+
+    if args.map:
+        text = format_map([(venue, mlists) for venue, (_, mlists, _) in zip(venues, results)])
+        try:
+            with open(args.map) as f:
+                old = f.read()
+        except FileNotFoundError:
+            old = None
+        if text != old:
+            write_atomic(args.map, text)
+            changed.append(args.map)
+
+    if changed:
+        print(f'changed: {" ".join(changed)}')
     else:
-        with open(f'{mlistname}.{venue}.txt', 'w') as out_file:
-            print('\n'.join(mlist), file=out_file)
+        return(1)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -6,22 +6,391 @@ import glob
 import os.path
 import sys
 import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import gzip
 import pprint
 import re
+import time
+import hashlib
+import sqlite3
 import json
-import mailbox
+import email.parser
+import mmap
 import zoneinfo
+from concurrent.futures import ProcessPoolExecutor
 
-def getfield(parts, name, stripchars='<>'):
-    try:
-        field = [i for i in parts if i.startswith(f'{name}=')][0]
-        field = field.split('=')[1]
-        field = field.strip(stripchars)
-        return field
-    except IndexError:
+# the fields we want, anywhere after the start of a whitespace-separated token
+FIELD_RE = re.compile(r'(?<!\S)(to|from|message-id|orig_to|status)=(\S*)')
+
+# ISO8601 stamp, to the second, and any fraction
+ISO_RE = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?')
+
+# parsed stamps by their second-resolution text; log lines come in
+# bunches per second, so this rarely needs to parse
+DT_CACHE_SIZE = 10000
+
+def getfields(line):
+    # first value of each field in line, without any <> or trailing ,
+    fields = dict()
+    for name, value in FIELD_RE.findall(line):
+        if name not in fields:
+            fields[name] = value.rstrip(' ,').split('=')[0].strip('<>')
+    return fields
+
+def parse_timestamp(parts, fileyear, cache):
+    # returns (datetime, number of tokens in the stamp)
+    m = ISO_RE.match(parts[0])
+    if m:
+        # apparently logging, at least mail.log, has switched format
+        # to ISO8601; any timezone is dropped
+        key = m.group(1)
+        nparts = 1
+    else:
+        key = ' '.join(parts[0:3])
+        nparts = 3
+
+    dtval = cache.get(key)
+    if dtval is None:
+        if len(cache) >= DT_CACHE_SIZE:
+            cache.clear()
+        if nparts == 1:
+            dtval = datetime.datetime.fromisoformat(key)
+        else:
+            dtval = datetime.datetime.strptime(key + ' ' + str(fileyear), '%b %d %H:%M:%S %Y')
+        cache[key] = dtval
+
+    if nparts == 1 and m.group(2):
+        dtval = dtval.replace(microsecond=int(m.group(2)[:6].ljust(6, '0')))
+    return dtval, nparts
+
+def new_msg():
+    return dict(dt=None, fr=None, msgid=None, to=list(), orig_to='')
+
+def new_msgs():
+    # msgs[qid] = {'from': fromstr, 'messageid': msgid,
+    #                 'to': list(tostr1, tostr2, ..)}
+    return defaultdict(new_msg)
+
+def file_year(f):
+    # syslog stamps have no year; assume the file's
+    mtime = os.fstat(f.fileno()).st_mtime
+    dt_mtime = datetime.datetime.fromtimestamp(mtime)
+    return dt_mtime.year
+
+def parse_file(name, msgs, debug=False):
+    if name.endswith('.gz'):
+        f = gzip.open(name, 'rt')
+    else:
+        f = open(name, 'r')
+
+    with f:
+        return parse_lines(f, file_year(f), msgs, debug)
+
+def parse_line(line, fileyear, dt_cache):
+    # (qid, datetime, fields) for a line about a queue id, else None
+    # nearly all lines have none of the fields; don't even split
+    # those (orig_to= contains to=, and status= only matters with to=)
+    if 'to=' not in line and 'from=' not in line and 'message-id=' not in line:
+        return None
+    fields = getfields(line)
+    if not (fields.get('to') or fields.get('message-id') or fields.get('from') or fields.get('orig_to')):
+        return None
+
+    # stamp, hostname, logger name/pid, then the queue id
+    parts = line.split(maxsplit=6)
+    dtval, nparts = parse_timestamp(parts, fileyear, dt_cache)
+    qid = parts[nparts + 2].strip(' ,').rstrip(':')
+    return qid, dtval, fields
+
+def update_msg(md, line, dtval, fields):
+    md['origline'] = line.strip()
+    md['dt'] = dtval
+    md['status'] = fields.get('status')
+
+    if fields.get('to'):
+        md['to'].append(fields['to'])
+
+    if fields.get('message-id'):
+        md['msgid'] = fields['message-id']
+
+    if fields.get('from'):
+        md['fr'] = fields['from']
+
+    if fields.get('orig_to'):
+        md['orig_to'] = fields['orig_to']
+
+def parse_lines(lines, fileyear, msgs, debug=False):
+    dt_cache = dict()
+    for line in lines:
+        parsed = parse_line(line, fileyear, dt_cache)
+        if parsed is None:
+            continue
+        qid, dtval, fields = parsed
+        if debug:
+            print(f'{line=}')
+            print(f'date={dtval} to={fields.get("to")} from={fields.get("from")} '
+                  f'orig_to={fields.get("orig_to")} status={fields.get("status")}')
+        update_msg(msgs[qid], line, dtval, fields)
+
+    return msgs
+
+def parse_partial(name, debug=False):
+    # one file's queue ids, for a worker process to send back
+    return dict(parse_file(name, new_msgs(), debug))
+
+def merge(msgs, partial):
+    # fold in a partial map from a later file; a queue id spanning
+    # rotation ends up as if both files had been parsed in turn
+    for qid, md in partial.items():
+        if qid not in msgs:
+            msgs[qid] = md
+            continue
+        old = msgs[qid]
+        old['to'].extend(md['to'])
+        old['origline'] = md['origline']
+        old['dt'] = md['dt']
+        old['status'] = md['status']
+        for field in ('fr', 'msgid', 'orig_to'):
+            if md[field]:
+                old[field] = md[field]
+
+# parsed records, so queries needn't reread the logs; see --db/--ingest
+DB_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+        fingerprint TEXT PRIMARY KEY, name TEXT,
+        inode INTEGER, size INTEGER, mtime INTEGER, offset INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS addresses (
+        id INTEGER PRIMARY KEY, addr TEXT UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS records (
+        qid TEXT PRIMARY KEY, dt TEXT, fr TEXT, msgid TEXT,
+        orig_to INTEGER REFERENCES addresses, status TEXT, origline TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS recipients (
+        qid TEXT, addr INTEGER REFERENCES addresses)''',
+    'CREATE INDEX IF NOT EXISTS records_orig_to ON records (orig_to)',
+    'CREATE INDEX IF NOT EXISTS records_msgid ON records (msgid)',
+    'CREATE INDEX IF NOT EXISTS records_dt ON records (dt)',
+    'CREATE INDEX IF NOT EXISTS recipients_addr ON recipients (addr)',
+    'CREATE INDEX IF NOT EXISTS recipients_qid ON recipients (qid)',
+]
+
+def regexp(pattern, value):
+    # for SQL's "value REGEXP pattern", with --to/--orig-to's re.search
+    return value is not None and re.search(pattern, value) is not None
+
+def open_db(path):
+    conn = sqlite3.connect(path)
+    conn.create_function('REGEXP', 2, regexp, deterministic=True)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        for stmt in DB_SCHEMA:
+            conn.execute(stmt)
+    return conn
+
+def read_new_lines(f, state):
+    # complete lines from state['offset'] on, advancing it past each; a
+    # line still being written is left for next time
+    f.seek(state['offset'])
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        state['offset'] += len(line)
+        yield line.decode(errors='replace')
+
+def address_id(conn, addr, cache):
+    if not addr:
         return None
+    if addr not in cache:
+        conn.execute('INSERT OR IGNORE INTO addresses (addr) VALUES (?)', (addr,))
+        cache[addr] = conn.execute('SELECT id FROM addresses WHERE addr = ?', (addr,)).fetchone()[0]
+    return cache[addr]
+
+def store(conn, msgs):
+    # merge a partial map into the records as merge() would
+    ids = dict()
+    for qid, md in msgs.items():
+        conn.execute(
+            '''INSERT INTO records (qid, dt, fr, msgid, orig_to, status, origline)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (qid) DO UPDATE SET
+                   dt = excluded.dt, status = excluded.status, origline = excluded.origline,
+                   fr = coalesce(excluded.fr, fr),
+                   msgid = coalesce(excluded.msgid, msgid),
+                   orig_to = coalesce(excluded.orig_to, orig_to)''',
+            (qid, md['dt'].isoformat(), md['fr'] or None, md['msgid'] or None,
+             address_id(conn, md['orig_to'], ids), md['status'], md['origline']),
+        )
+        conn.executemany(
+            'INSERT INTO recipients (qid, addr) VALUES (?, ?)',
+            [(qid, address_id(conn, to, ids)) for to in md['to']],
+        )
+
+def ingest(conn, files, debug=False):
+    # Parse what's new in files into the store.  Files are known by a hash
+    # of their first line, so a log rotated to a new name (or compressed,
+    # with a new inode) is read from where we left off, and one that
+    # hasn't changed since last time isn't opened.
+    for name in files:
+        st = os.stat(name)
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if conn.execute(
+            'SELECT 1 FROM files WHERE inode = ? AND size = ? AND mtime = ?', stat
+        ).fetchone():
+            continue
+
+        if name.endswith('.gz'):
+            f = gzip.open(name, 'rb')
+        else:
+            f = open(name, 'rb')
+        with f:
+            first = f.readline()
+            if not first.endswith(b'\n'):
+                continue
+            fingerprint = hashlib.sha256(first).hexdigest()
+            row = conn.execute(
+                'SELECT offset FROM files WHERE fingerprint = ?', (fingerprint,)
+            ).fetchone()
+            state = dict(offset=row[0] if row else 0)
+
+            msgs = parse_lines(read_new_lines(f, state), file_year(f), new_msgs(), debug)
+            with conn:
+                store(conn, msgs)
+                conn.execute(
+                    '''INSERT OR REPLACE INTO files (fingerprint, name, inode, size, mtime, offset)
+                       VALUES (?, ?, ?, ?, ?, ?)''',
+                    (fingerprint, name, *stat, state['offset']),
+                )
+
+def query(conn, args):
+    # the records --to, --orig-to and --other would select, as parse_file() makes them
+    where = []
+    params = []
+    if args.to:
+        where.append('''qid IN (SELECT qid FROM recipients WHERE addr IN
+                        (SELECT id FROM addresses WHERE addr REGEXP ?))''')
+        params.append(args.to)
+    if args.orig_to:
+        where.append('orig_to IN (SELECT id FROM addresses WHERE addr REGEXP ?)')
+        params.append(args.orig_to)
+    if args.other:
+        where.append('instr(origline, ?) > 0')
+        params.append(args.other)
+
+    sql = '''SELECT qid, dt, fr, msgid, a.addr, status, origline FROM records
+             LEFT JOIN addresses a ON a.id = orig_to'''
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    # log order, as a parse of the files would give
+    sql += ' ORDER BY dt, records.rowid'
+    msgs = dict()
+    for qid, dt, fr, msgid, orig_to, status, origline in conn.execute(sql, params):
+        msgs[qid] = dict(
+            dt=datetime.datetime.fromisoformat(dt), fr=fr, msgid=msgid, to=list(),
+            orig_to=orig_to or '', origline=origline, status=status,
+        )
+
+    # SQLite allows only so many ? per statement
+    qids = list(msgs)
+    for i in range(0, len(qids), 500):
+        chunk = qids[i:i + 500]
+        for qid, addr in conn.execute(
+            f'''SELECT r.qid, a.addr FROM recipients r JOIN addresses a ON a.id = r.addr
+                WHERE r.qid IN ({', '.join('?' * len(chunk))}) ORDER BY r.rowid''',
+            chunk,
+        ):
+            msgs[qid]['to'].append(addr)
+    return msgs
+
+# --follow: how often to look for more lines, and for rotation
+FOLLOW_POLL = 0.5
+
+# "QID: removed": postfix is done with the queue id
+REMOVED_RE = re.compile(r'\s([0-9A-Za-z]+): removed\s*$')
+
+def follow_lines(path):
+    # lines appended to path, forever, reopening it when it's rotated
+    # (a new inode) or truncated; yields None when there's nothing new
+    f = open(path, 'r')
+    f.seek(0, os.SEEK_END)
+    partial = ''
+    while True:
+        line = f.readline()
+        if line:
+            partial += line
+            if partial.endswith('\n'):
+                yield f, partial
+                partial = ''
+            continue
+
+        yield f, None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            # between rename and create
+            continue
+        if st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell():
+            # anything written to the old file before the switch was
+            # read above; start the new one from the top
+            f.close()
+            f = open(path, 'r')
+            partial = ''
+
+def follow(path, args):
+    # Emit each delivery attempt as its status= line arrives: the queue
+    # id's record so far, with just that line's recipient and status.
+    # Queue ids are dropped when postfix removes them, or when nothing
+    # has been seen for them in args.window seconds.
+    msgs = OrderedDict()
+    last_seen = dict()
+    dt_cache = dict()
+    fileyear = None
+    current = None
+    for f, line in follow_lines(path):
+        now = time.monotonic()
+        while msgs:
+            qid = next(iter(msgs))
+            if now - last_seen[qid] < args.window:
+                break
+            del msgs[qid], last_seen[qid]
+
+        if line is None:
+            sys.stdout.flush()
+            time.sleep(FOLLOW_POLL)
+            continue
+        if f is not current:
+            current = f
+            fileyear = file_year(f)
+
+        m = REMOVED_RE.search(line)
+        if m:
+            msgs.pop(m.group(1), None)
+            last_seen.pop(m.group(1), None)
+            continue
+
+        parsed = parse_line(line, fileyear, dt_cache)
+        if parsed is None:
+            continue
+        qid, dtval, fields = parsed
+        md = msgs.setdefault(qid, new_msg())
+        msgs.move_to_end(qid)
+        last_seen[qid] = now
+        update_msg(md, line, dtval, fields)
+
+        if fields.get('status') and fields.get('to'):
+            delivery = dict(md, to=[fields['to']])
+            if matches(delivery, args):
+                output(delivery, args)
+
+def matches(msg, args):
+    # the --to, --orig-to and --other filters
+    if args.to:
+        if not any([re.search(args.to, to) for to in msg['to']]):
+            return False
+    if args.orig_to:
+        if 'orig_to' not in msg or not re.search(args.orig_to, msg['orig_to']):
+            return False
+    if args.other and args.other not in msg['origline']:
+        return False
+    return True
 
 def parse_args():
     ap = argparse.ArgumentParser()
@@ -32,8 +401,18 @@ def parse_args():
     ap.add_argument('-j', '--json', action='store_true', help='json output')
     ap.add_argument('-m', '--msgid', action='store_true', help='parse host Sent box for msgids, show from/to/subject/date')
     ap.add_argument('-O', '--other', help='Other required strings for the log line')
+    ap.add_argument('-J', '--jobs', type=int, default=1, help='parse this many files at once, in separate processes')
+    ap.add_argument('-D', '--db', help='answer from this database of parsed records instead of the logs')
+    ap.add_argument('-i', '--ingest', action='store_true', help='add anything new in the logs to --db first')
+    ap.add_argument('-f', '--follow', action='store_true', help='watch mail.log (or the one file given), showing deliveries as they happen')
+    ap.add_argument('-w', '--window', type=float, default=3600, help='with --follow, forget queue ids not seen for this many seconds')
     ap.add_argument('files', nargs='*')
-    return ap.parse_args()
+    args = ap.parse_args()
+    if args.ingest and not args.db:
+        ap.error('--ingest needs --db')
+    if args.follow and (args.db or args.msgid or len(args.files) > 1):
+        ap.error('--follow takes at most one file, and not --db or --msgid')
+    return args
 
 def output(msg, args):
 
@@ -64,106 +443,131 @@ def output(msg, args):
         else:
             print()
 
-def search_mbox(path, msgids):
-    msgs = list()
-    mbox = mailbox.mbox(path, create=False)
-    for m in mbox.items():
-        if m[1]['message-id'].strip('<>') in msgids:
-            msgs.append(m[1])
+# Sent mbox for --msgid, and where to keep its msgid -> offset index
+SENT_MBOX = '/home/host/mail/Sent'
+SENT_INDEX = os.path.expanduser('~/.parsemaillog-sent.db')
+
+MSGID_RE = re.compile(rb'^message-id:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.I | re.M)
+
+def scan_mbox(mm, start=0):
+    # (offset, msgid or None) for each message from start, which must be
+    # at a "From " line, on; only the headers are looked at
+    pos = start
+    while pos < len(mm):
+        nxt = mm.find(b'\nFrom ', pos)
+        end = len(mm) if nxt < 0 else nxt + 1
+        hdr_end = mm.find(b'\n\n', pos, end)
+        m = MSGID_RE.search(mm[pos:end if hdr_end < 0 else hdr_end])
+        msgid = None
+        if m:
+            msgid = b' '.join(m.group(1).split()).decode(errors='replace').strip('<>')
+        yield pos, msgid
+        pos = end
+
+def update_sent_index(conn, mm):
+    # Index messages added since last time.  The last message indexed is
+    # always rescanned, in case it was still being written; if it's not
+    # where it was, the mbox has been rewritten, so start over.
+    conn.execute('CREATE TABLE IF NOT EXISTS sent (msgid TEXT, offset INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS sent_msgid ON sent (msgid)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sent_state (size INTEGER, last INTEGER, last_hash TEXT)')
+
+    start = 0
+    row = conn.execute('SELECT size, last, last_hash FROM sent_state').fetchone()
+    if row:
+        size, last, last_hash = row
+        if size <= len(mm) and hashlib.sha256(mm[last:min(size, last + 1024)]).hexdigest() == last_hash:
+            if size == len(mm):
+                return
+            start = last
+
+    conn.execute('DELETE FROM sent WHERE offset >= ?', (start,))
+    last = start
+    rows = []
+    for offset, msgid in scan_mbox(mm, start):
+        last = offset
+        if msgid:
+            rows.append((msgid, offset))
+    conn.executemany('INSERT INTO sent (msgid, offset) VALUES (?, ?)', rows)
+    conn.execute('DELETE FROM sent_state')
+    conn.execute(
+        'INSERT INTO sent_state (size, last, last_hash) VALUES (?, ?, ?)',
+        (len(mm), last, hashlib.sha256(mm[last:min(len(mm), last + 1024)]).hexdigest()),
+    )
+
+def search_mbox(path, msgids, index=SENT_INDEX):
+    msgids = list(set(msgids) - {None})
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return list()
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    conn = sqlite3.connect(index)
+    with mm, conn:
+        update_sent_index(conn, mm)
+        offsets = list()
+        # SQLite allows only so many ? per statement
+        for i in range(0, len(msgids), 500):
+            chunk = msgids[i:i + 500]
+            offsets.extend(o for o, in conn.execute(
+                f'SELECT offset FROM sent WHERE msgid IN ({", ".join("?" * len(chunk))})', chunk
+            ))
+
+        # in mbox order, as mailbox would have found them
+        msgs = list()
+        parser = email.parser.BytesHeaderParser()
+        for offset in sorted(offsets):
+            hdr_end = mm.find(b'\n\n', offset)
+            msgs.append(parser.parsebytes(mm[offset:len(mm) if hdr_end < 0 else hdr_end + 1]))
+    conn.close()
     return msgs
-        
 
 def main():
-    # msgs[qid] = {'from': fromstr, 'messageid': msgid, 
-    #                 'to': list(tostr1, tostr2, ..)}
-    msgs = defaultdict(
-        lambda: dict(dt=None, fr=None, msgid=None, to=list(), orig_to='')
-    )
+    msgs = new_msgs()
 
     args = parse_args()
+    if args.follow:
+        try:
+            follow(args.files[0] if args.files else '/var/log/mail.log', args)
+        except KeyboardInterrupt:
+            pass
+        return
+
     if not args.files:
         files = glob.glob('/var/log/mail.log*')
         files.sort(key=os.path.getmtime)
         args.files = files
 
     # this server was always in UTC
-    for name in args.files:
-        if name.endswith('.gz'):
-            f = gzip.open(name, 'rt')
-        else:
-            f = open(name, 'r')
-
-        mtime = os.fstat(f.fileno()).st_mtime
-        dt_mtime = datetime.datetime.fromtimestamp(mtime)
-        fileyear = dt_mtime.year
-        for line in f:
-            parts = line.split()
-            parts = [p.strip(' ,') for p in parts]
-
-            # apparently logging, at least mail.log, has switched format
-            # to ISO8601
-            try:
-                dtval=datetime.datetime.fromisoformat(parts[0])
-                dtval=dtval.replace(tzinfo=None)
-                parts = parts[1:]
-            except ValueError:
-                dt_parts = parts[0:3]
-                parts = parts[3:]
-                dtval=datetime.datetime.strptime(
-                    ' '.join(dt_parts) + ' ' + str(fileyear),'%b %d %H:%M:%S %Y')
-            # skip hostname, logger name/pid
-            parts = parts[2:]
-
-            to = getfield(parts, 'to')
-            messageid = getfield(parts, 'message-id')
-            fr = getfield(parts, 'from')
-            orig_to = getfield(parts, 'orig_to')
-            status = getfield(parts, 'status')
-
-            if to or messageid or fr or orig_to:
-                if args.debug:
-                    print(f'{line=}')
-                    print(f'date={dtval} {to=} from={fr} {orig_to=} {status=}')
-                qid = parts.pop(0).rstrip(':')
-                md = msgs[qid]
-                md['origline'] = line.strip()
-                md['dt'] = dtval
-                md['status'] = status
-
-            if to:
-                md['to'].append(to)
-
-            if messageid:
-                md['msgid'] = messageid
-
-            if fr:
-                md['fr'] = fr
-
-            if orig_to:
-                md['orig_to'] = orig_to
-
-
-        f.close()
+    if args.db:
+        conn = open_db(args.db)
+        if args.ingest:
+            ingest(conn, args.files, args.debug)
+            if not (args.to or args.orig_to or args.other or args.msgid):
+                return
+        msgs = query(conn, args)
+    elif args.jobs > 1:
+        # partial maps come back in file order, so merge in that order
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for partial in pool.map(parse_partial, args.files, [args.debug] * len(args.files)):
+                merge(msgs, partial)
+    else:
+        for name in args.files:
+            parse_file(name, msgs, args.debug)
 
     truncate = False
 
-    msgids = list()
+    msgids = set()
     for qid, msg in sorted(msgs.items(), key=lambda kv: kv[1]['dt']):
-        if args.to:
-            if not any([re.search(args.to, to) for to in msg['to']]):
-                continue
-        if args.orig_to:
-            if 'orig_to' not in msg or not re.search(args.orig_to, msg['orig_to']):
-                continue
-        if args.other and args.other not in msg['origline']:
+        if not matches(msg, args):
             continue
         if args.msgid:
-            msgids.append(msg['msgid'])
+            msgids.add(msg['msgid'])
         else:
             output(msg, args)
 
     if args.msgid:
-        for sentmsg in search_mbox('/home/host/mail/Sent', msgids):
+        for sentmsg in search_mbox(SENT_MBOX, msgids):
             print(f'''
 From: {sentmsg.get('from')}
 To: {sentmsg.get('to')}
@@ -0,0 +1,123 @@
+from sqlmodel import SQLModel, Field, Session, col, delete, select
+from sqlalchemy.dialects.sqlite import insert
+import json
+import re
+import time
+import urllib.parse
+import config
+import logging
+import lyrics_db
+
+log = logging.getLogger(__name__)
+
+
+class ApiResponse(SQLModel, table=True):
+    # lrclib responses by normalized api path, including misses, so
+    # lookups that failed recently aren't repeated on every page load
+    path: str = Field(primary_key=True)
+    status: int
+    body: str
+    negative: bool
+    fetched: float
+    used: float = Field(index=True)
+
+
+def normalize_path(path: str) -> str:
+    # queries that differ only in parameter order, case or spacing get
+    # the same answer from lrclib
+    base, _, query = path.partition('?')
+    if not query:
+        return base
+    params = sorted(
+        (k, re.sub(r'\s+', ' ', v).strip().casefold())
+        for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True)
+    )
+    return f'{base}?{urllib.parse.urlencode(params)}'
+
+
+# the only answers worth keeping; anything else (429, 401, 5xx...) says
+# nothing about the song
+CACHEABLE_STATUSES = (200, 400, 404)
+
+
+def is_negative(status: int, body: str) -> bool:
+    # 404/400, or a search with no results
+    return status in (400, 404) or body.strip() == '[]'
+
+
+# the fields of an lrclib answer anything reads (lyrics_utils.fetch_lyrics,
+# search_song, and the name/message of a 400); the rest, synced lyrics
+# especially, isn't worth keeping
+KEPT_FIELDS = ('instrumental', 'plainLyrics', 'artistName', 'name', 'message')
+
+
+def slim_body(body: str) -> str:
+    # body with only KEPT_FIELDS of the record (or of each search result)
+    try:
+        j = json.loads(body)
+    except ValueError:
+        return body
+
+    def slim(record):
+        if not isinstance(record, dict):
+            return record
+        return {k: v for k, v in record.items() if k in KEPT_FIELDS}
+
+    if isinstance(j, list):
+        return json.dumps([slim(r) for r in j])
+    return json.dumps(slim(j))
+
+
+def lookup(path: str) -> tuple[int, str] | None:
+    '''
+    Return (status, body) cached for path if it hasn't expired
+    '''
+    now = time.time()
+    with Session(lyrics_db.get_engine()) as session:
+        entry = session.get(ApiResponse, path)
+        if entry is None or entry.status not in CACHEABLE_STATUSES:
+            return None
+        ttl = config.API_CACHE_NEGATIVE_TTL if entry.negative else config.API_CACHE_POSITIVE_TTL
+        if now - entry.fetched > ttl:
+            return None
+        # LRU order only needs to be roughly right; don't make every hit
+        # a write
+        if now - entry.used > config.API_CACHE_USED_INTERVAL:
+            entry.used = now
+            session.add(entry)
+            session.commit()
+        log.debug(f'api cache hit {path} {entry.status}')
+        return entry.status, entry.body
+
+
+# stores since the last eviction pass
+_stores = 0
+
+
+def store(path: str, status: int, body: str):
+    global _stores
+    now = time.time()
+    body = slim_body(body)
+    values = dict(
+        path=path,
+        status=status,
+        body=body,
+        negative=is_negative(status, body),
+        fetched=now,
+        used=now,
+    )
+    stmt = insert(ApiResponse).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['path'],
+        set_={k: stmt.excluded[k] for k in values if k != 'path'},
+    )
+    with Session(lyrics_db.get_engine()) as session:
+        session.exec(stmt)
+        _stores += 1
+        if _stores >= config.API_CACHE_EVICT_EVERY:
+            # evict least recently used entries beyond the size limit; the
+            # cache can run over by up to API_CACHE_EVICT_EVERY meanwhile
+            _stores = 0
+            keep = select(ApiResponse.path).order_by(col(ApiResponse.used).desc()).offset(config.API_CACHE_MAX_ENTRIES)
+            session.exec(delete(ApiResponse).where(col(ApiResponse.path).in_(keep)))
+        session.commit()
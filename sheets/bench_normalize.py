@@ -0,0 +1,75 @@
+#!/home/dmick/src/jamtools/sheets/v/bin/python3
+
+import argparse
+import csv
+import re
+import sys
+import time
+
+import lyrics_utils
+import normalize
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Compare cleanup() normalization throughput, per-call '
+                    're.sub vs. the compiled Normalizer, over a setlist csv '
+                    '(as written by fetch_sets.py)')
+    parser.add_argument('csvfile', nargs='?', default='sets.csv')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='passes over the corpus')
+    parser.add_argument('-a', '--aliases', type=int, default=0,
+                        help='add this many made-up literal aliases to each table')
+    return parser.parse_args()
+
+
+def resub_all(table, s):
+    # what cleanup() used to do
+    for search, replace in table:
+        s = re.sub(search, replace, s)
+    return s
+
+
+def bench(name, fn, corpus, repeat) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for s in corpus:
+            fn(s)
+    elapsed = time.perf_counter() - start
+    rate = len(corpus) * repeat / elapsed
+    print(f'{name:>12}: {elapsed:8.3f}s {rate:12.0f} strings/s')
+    return elapsed
+
+
+def main() -> int:
+    args = parse_args()
+    with open(args.csvfile, newline='') as f:
+        rows = list(csv.DictReader(f))
+    corpus = {
+        'song': [r['song'] for r in rows if r.get('song')],
+        'artist': [r['artist'] for r in rows if r.get('artist')],
+    }
+
+    for which, table in (('song', lyrics_utils.re_subs_song), ('artist', lyrics_utils.re_subs_artist)):
+        table = table + [(f'Alias{i} Band', f'Aliased Band {i}') for i in range(args.aliases)]
+        engine = normalize.Normalizer(table)
+        strings = corpus[which]
+        print(f'{which}: {len(strings)} strings ({len(set(strings))} distinct), '
+              f'{len(table)} rewrites in {len(engine.steps)} steps')
+
+        mismatches = [s for s in set(strings) if resub_all(table, s) != engine(s)]
+        if mismatches:
+            print(f'MISMATCH for {mismatches[:5]}', file=sys.stderr)
+            return 1
+
+        # the corpus repeats itself, so the memoized engine mostly measures
+        # cache hits; _normalize is the compiled rewrite on its own
+        old = bench('re.sub', lambda s: resub_all(table, s), strings, args.repeat)
+        uncached = bench('uncached', engine._normalize, strings, args.repeat)
+        engine.normalize.cache_clear()
+        cached = bench('Normalizer', engine, strings, args.repeat)
+        print(f'{"speedup":>12}: {old / uncached:8.1f}x uncached, {old / cached:.1f}x with cache')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
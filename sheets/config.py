@@ -69,6 +69,9 @@ LYRICS_FORM = '''
 <input type=checkbox id="html" name="html" value="true">
 <label for="html" id="htmllabel">Output HTML (run show from browser)</label>
 <p></p>
+<input type=checkbox id="stream" name="stream" value="true">
+<label for="stream" id="streamlabel">Show songs as they're found</label>
+<p></p>
 <button type="submit" id="go">Go</button>
 '''
 
@@ -81,3 +84,81 @@ DATEONLY_FORM = '''
   <p></p>
   <button type="submit" id="go">Go</button>
 '''
+
+# lrclib client: connection pool size, keepalive and request timeout (seconds)
+LRCLIB_MAX_CONNECTIONS = 10
+LRCLIB_KEEPALIVE = 60.0
+LRCLIB_TIMEOUT = 15.0
+
+# how many lrclib lookups fetch_and_retry may run concurrently for one
+# song; 1 tries them one at a time
+PROBE_FANOUT = 4
+
+# lrclib response cache (kept in SQLITE_FILE): seconds to trust a hit,
+# seconds to trust a miss, and the most responses to keep
+API_CACHE_POSITIVE_TTL = 30 * 24 * 3600
+API_CACHE_NEGATIVE_TTL = 6 * 3600
+API_CACHE_MAX_ENTRIES = 20000
+
+# how stale (seconds) an entry's last-used time may get before a hit
+# updates it, and how many stores between eviction passes
+API_CACHE_USED_INTERVAL = 3600
+API_CACHE_EVICT_EVERY = 100
+
+# in-memory lyrics cache in front of SQLITE_FILE: most songs, and most
+# bytes of lyric text, to keep
+HOT_LYRICS_MAX_ENTRIES = 500
+HOT_LYRICS_MAX_BYTES = 8 * 1024 * 1024
+
+# rendered /lyrics and /setlist pages kept for ETag revalidation
+RENDERED_PAGES_MAX_ENTRIES = 100
+RENDERED_PAGES_MAX_BYTES = 16 * 1024 * 1024
+
+# local mirror of the setlist index and sheets (see sync_sheets.py)
+SHEET_MIRROR_FILE = "/home/dmick/src/jamtools/sheet_mirror.db"
+
+# Sheets API read budget (the default per-user quota is 60/minute), how
+# many reads may go out back to back, and how many sheet reads to send per
+# batch HTTP request
+SHEETS_READS_PER_MINUTE = 60
+SHEETS_READ_BURST = 10
+SHEETS_BATCH_SIZE = 10
+
+# retries of a rate-limited Sheets read, and the most seconds to back off
+# when the server doesn't send Retry-After
+SHEETS_MAX_RETRIES = 8
+SHEETS_MAX_BACKOFF = 64
+
+# Retry-After seconds for a lyrics_server page that couldn't read its set
+# because the Sheets read budget was used up (it doesn't wait for it)
+SHEETS_RETRY_AFTER = 5
+
+# seconds to keep the setlist index before rereading it, and how old it
+# must be before a date that isn't in it causes a reread
+SET_INDEX_TTL = 600
+SET_INDEX_MIN_AGE = 30
+
+# seconds lyrics_server keeps a set's rows before rereading its sheet, and
+# how many sets' rows it keeps
+SET_ROWS_TTL = 60
+SET_ROWS_MAX_ENTRIES = 64
+
+# sets database built by script/repopulate, how many read-only
+# connections to it /search may hold open, and how many seconds a search
+# waits for one
+SETS_DB_FILE = "/home/dmick/src/jamtools/sheets/sets.db"
+SETS_DB_POOL_SIZE = 4
+SETS_DB_POOL_TIMEOUT = 10
+
+# hand-made lyrics, as <artist>-<song>.txt, served instead of lrclib's,
+# and how often (seconds) to check the directory for changes
+LYRICS_OVERRIDE_DIR = "/var/www/html/lyrics-override"
+LYRICS_OVERRIDE_CHECK_INTERVAL = 5
+
+# background lyrics prefetch (prefetch.py, and lyrics_server unless the
+# interval is 0): sets from this many days back through this many ahead,
+# a pass every PREFETCH_INTERVAL seconds, pausing between songs
+PREFETCH_DAYS_AHEAD = 7
+PREFETCH_DAYS_BACK = 1
+PREFETCH_INTERVAL = 1800
+PREFETCH_PAUSE = 1.0
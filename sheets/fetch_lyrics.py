@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 
 import csv
-from lyrics_utils import fetch_and_retry, SEPARATOR
+from lyrics_utils import fetch_and_retry_sync, SEPARATOR
 import sys
 
 def main():
@@ -14,7 +14,7 @@ def main():
         artist = row['artist']
         song = row['song']
         print(f'Looking for {song} {artist}', file=sys.stderr)
-        lyrics = fetch_and_retry(song, artist)
+        lyrics = fetch_and_retry_sync(song, artist)
         if lyrics is None:
             print()
             print(f'*** {song} - {artist}: Lyrics not found ***')
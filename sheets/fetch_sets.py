@@ -3,6 +3,7 @@
 import argparse
 import csv
 import datetime
+import itertools
 
 import sys
 import google_utils
@@ -18,29 +19,34 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('-s', '--start', help='Output info from date greater than given date')
     parser.add_argument('-l', '--list', action='store_true', help='output only title,artist')
     parser.add_argument('-L', '--list2', action='store_true', help='output only artist - title')
+    parser.add_argument('-m', '--mirror', action='store_true', help='read sets from the local mirror (see sync_sheets.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='fetch this many sheets concurrently')
     return parser.parse_args()
 
 def main() -> int:
     args = parse_args()
 
-    rows:list[dict[str, str]] = []
-
     if ((args.id or args.date) and args.start):
         print("--id/--date and --start are mutually exclusive", file=sys.stderr)
         return 1
 
-    rows = set_utils.find_set(args.id, args.start, args.date)
+    sets = set_utils.iter_sets(args.id, args.start, args.date, args.mirror, args.jobs)
 
-    if args.date and len(rows) == 0:
+    first = next(sets, None)
+    if args.date and (first is None or len(first[1]) == 0):
         print(f'No set found for {args.date}', file=sys.stderr)
         return 1
+    if first is not None:
+        sets = itertools.chain([first], sets)
 
     if args.list2:
-        for row in rows:
-            if 'artist' in row and 'song' in row:
-                print(f'{row["artist"]} - {row["song"]}')
-            else:
-                print()
+        for _, rows in sets:
+            for row in rows:
+                if 'artist' in row and 'song' in row:
+                    print(f'{row["artist"]} - {row["song"]}')
+                else:
+                    print()
+            sys.stdout.flush()
         return 0
 
     if args.list:
@@ -49,7 +55,10 @@ def main() -> int:
         fields = set_utils.cleanfields(set_utils.ALLFIELDS)
     cw = csv.DictWriter(sys.stdout, fields, extrasaction='ignore')
     cw.writeheader()
-    cw.writerows(rows)
+    # write each set as soon as we have it
+    for _, rows in sets:
+        cw.writerows(rows)
+        sys.stdout.flush()
     return 0
 
 
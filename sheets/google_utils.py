@@ -6,21 +6,69 @@ from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 import os
 import functools
+import threading
 import config
 
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+SCOPES = ('https://www.googleapis.com/auth/spreadsheets.readonly',)
+DRIVE_SCOPES = ('https://www.googleapis.com/auth/drive.metadata.readonly',)
 
 @functools.cache
-def _get_creds_service_account(credfile):
+def _get_creds_service_account(credfile, scopes=SCOPES):
     return service_account.Credentials.from_service_account_file(
-        credfile, scopes=SCOPES)
+        credfile, scopes=list(scopes))
 
-@functools.cache
-def get_sheetservice(credfile=config.DEFAULT_CREDFILE):
+# the http object under a service isn't thread-safe, so each thread
+# gets its own
+_local = threading.local()
+
+def get_service(credfile=config.DEFAULT_CREDFILE):
     # hook up to the Google API
-    creds = _get_creds_service_account(os.path.expanduser(credfile))
-    service = build('sheets', 'v4', credentials=creds)
-    return service.spreadsheets()
+    services = _local.__dict__.setdefault('services', {})
+    if credfile not in services:
+        creds = _get_creds_service_account(os.path.expanduser(credfile))
+        services[credfile] = build('sheets', 'v4', credentials=creds)
+    return services[credfile]
+
+def get_sheetservice(credfile=config.DEFAULT_CREDFILE):
+    return get_service(credfile).spreadsheets()
+
+@functools.cache
+def get_driveservice(credfile=config.DEFAULT_CREDFILE):
+    # Drive metadata (modifiedTime), see attic/modtime.py
+    creds = _get_creds_service_account(os.path.expanduser(credfile), DRIVE_SCOPES)
+    service = build('drive', 'v3', credentials=creds)
+    return service.files()
+
+def get_modified_times(sheetids):
+    '''
+    Return {sheetid: modifiedTime} for those of sheetids Drive will tell
+    us about.  Everything visible to the service account is listed a
+    page at a time, rather than asking about each sheet.
+    '''
+    wanted = set(sheetids)
+    files = get_driveservice()
+    modified = {}
+    request = files.list(
+        q="mimeType='application/vnd.google-apps.spreadsheet' and trashed=false",
+        fields='nextPageToken, files(id,modifiedTime)',
+        pageSize=1000,
+        includeItemsFromAllDrives=True,
+        supportsAllDrives=True,
+    )
+    while request is not None:
+        resp = request.execute()
+        for f in resp.get('files', []):
+            if f['id'] in wanted:
+                modified[f['id']] = f['modifiedTime']
+        request = files.list_next(request, resp)
+
+    for sheetid in wanted - modified.keys():
+        try:
+            f = files.get(fileId=sheetid, fields='modifiedTime', supportsAllDrives=True).execute()
+            modified[sheetid] = f['modifiedTime']
+        except HttpError:
+            pass
+    return modified
 
 
 
@@ -0,0 +1,126 @@
+#!/home/dmick/src/jamtools/sheets/v/bin/python3
+
+import argparse
+import sqlite3
+import sys
+
+import config
+import set_utils
+import sets_search
+
+COLUMNS = set_utils.cleanfields(set_utils.ALLFIELDS)
+INT_COLUMNS = ['date', 'songnum']
+KEY = ['date', 'songnum']
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Add sets to the sets database, replacing any rows '
+                    'already there for the same date and song number')
+    parser.add_argument('-i', '--id', help='Google spreadsheet ID to add')
+    parser.add_argument('-d', '--date', help='Date of set to add (MM/DD/YYYY or YYYY-MM-DD)')
+    parser.add_argument('-s', '--start', help='Add sets from this date on')
+    parser.add_argument('-m', '--mirror', action='store_true', help='read sets from the local mirror (see sync_sheets.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='fetch this many sheets concurrently')
+    parser.add_argument('--db', default=config.SETS_DB_FILE, help='sets database')
+    parser.add_argument('--replace', action='store_true', help='THIS DESTROYS CURRENT DATA: start from empty tables')
+    return parser.parse_args()
+
+
+def setup(conn: sqlite3.Connection, replace: bool = False):
+    '''
+    Make sure the sets table has a unique (date, songnum) index and that
+    sets_fts (as made by sqlite-utils enable-fts) is kept current by
+    triggers.  A table from the old sqlite-utils pipeline is deduplicated
+    (keeping the newest copy of each song) and its index rebuilt once.
+    '''
+    if replace:
+        conn.execute('DROP TABLE IF EXISTS sets')
+        conn.execute('DROP TABLE IF EXISTS sets_fts')
+
+    coldefs = ', '.join(f'[{c}] {"INTEGER" if c in INT_COLUMNS else "TEXT"}' for c in COLUMNS)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS sets ({coldefs})')
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sets_date_songnum'").fetchone():
+        return
+
+    conn.execute('''DELETE FROM sets WHERE rowid NOT IN
+                    (SELECT MAX(rowid) FROM sets GROUP BY date, songnum)''')
+    conn.execute('CREATE UNIQUE INDEX sets_date_songnum ON sets (date, songnum)')
+
+    fts = ', '.join(f'[{c}]' for c in sets_search.FTS_COLUMNS)
+    new = ', '.join(f'new.[{c}]' for c in sets_search.FTS_COLUMNS)
+    old = ', '.join(f'old.[{c}]' for c in sets_search.FTS_COLUMNS)
+    # one statement at a time: executescript() would commit our transaction
+    for stmt in [
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS [sets_fts] USING FTS5 ({fts}, content=[sets])',
+        f'''CREATE TRIGGER IF NOT EXISTS [sets_ai] AFTER INSERT ON [sets] BEGIN
+            INSERT INTO [sets_fts] (rowid, {fts}) VALUES (new.rowid, {new});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS [sets_ad] AFTER DELETE ON [sets] BEGIN
+            INSERT INTO [sets_fts] ([sets_fts], rowid, {fts}) VALUES('delete', old.rowid, {old});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS [sets_au] AFTER UPDATE ON [sets] BEGIN
+            INSERT INTO [sets_fts] ([sets_fts], rowid, {fts}) VALUES('delete', old.rowid, {old});
+            INSERT INTO [sets_fts] (rowid, {fts}) VALUES (new.rowid, {new});
+        END''',
+        "INSERT INTO [sets_fts] ([sets_fts]) VALUES ('rebuild')",
+    ]:
+        conn.execute(stmt)
+
+
+def upsert_set(conn: sqlite3.Connection, rows: list[dict[str, str]]) -> int:
+    # rows of one set; rows that didn't change aren't rewritten, so
+    # their FTS entries aren't either.  Returns the number of rows changed.
+    if not rows:
+        return 0
+    cols = ', '.join(f'[{c}]' for c in COLUMNS)
+    params = ', '.join(f':{c}' for c in COLUMNS)
+    updates = [c for c in COLUMNS if c not in KEY]
+    changed = conn.executemany(
+        f'''INSERT INTO sets ({cols}) VALUES ({params})
+            ON CONFLICT (date, songnum) DO UPDATE SET
+                {", ".join(f"[{c}] = excluded.[{c}]" for c in updates)}
+            WHERE {" OR ".join(f"sets.[{c}] IS NOT excluded.[{c}]" for c in updates)}''',
+        [
+            {c: int(r[c]) if c in INT_COLUMNS else r.get(c, '') for c in COLUMNS}
+            for r in rows
+        ],
+    ).rowcount
+    # the set may have gotten shorter
+    changed += conn.execute(
+        'DELETE FROM sets WHERE date = ? AND songnum > ?',
+        (int(rows[0]['date']), max(int(r['songnum']) for r in rows)),
+    ).rowcount
+    return changed
+
+
+def main() -> int:
+    args = parse_args()
+
+    if ((args.id or args.date) and args.start):
+        print("--id/--date and --start are mutually exclusive", file=sys.stderr)
+        return 1
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+
+    nsets = changed = 0
+    # everything in one transaction: readers see all of it or none
+    conn.execute('BEGIN')
+    try:
+        setup(conn, args.replace)
+        for _, rows in set_utils.iter_sets(args.id, args.start, args.date, args.mirror, args.jobs):
+            changed += upsert_set(conn, rows)
+            nsets += 1
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    print(f'{nsets} sets, {changed} rows changed', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+from sqlmodel import SQLModel, Field, Session, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+import logging
+import lyrics_db
+
+log = logging.getLogger(__name__)
+
+
+class Lyrics(SQLModel, table=True):
+    # the (song, artist) primary key is the composite index lookups use
+    song: str = Field(primary_key=True)
+    artist: str = Field(primary_key=True)
+    lyrics: str
+
+
+def get_lyrics(pairs: list[tuple[str, str]]) -> dict[tuple[str, str], str]:
+    '''
+    Return cached lyrics for any of the (song, artist) pairs we have, in
+    one query
+    '''
+    if not pairs:
+        return {}
+    with Session(lyrics_db.get_engine()) as session:
+        results = session.exec(
+            select(Lyrics).where(
+                tuple_(Lyrics.song, Lyrics.artist).in_(set(pairs))
+            )
+        )
+        return {(l.song, l.artist): l.lyrics for l in results}
+
+
+def put_lyrics(rows: list[dict]):
+    '''
+    Insert or replace lyrics for rows of song/artist/lyrics in one statement
+    '''
+    # last one wins if a song appears twice in a set
+    values = list({
+        (r['song'], r['artist']): dict(song=r['song'], artist=r['artist'], lyrics=r['lyrics'])
+        for r in rows
+    }.values())
+    if not values:
+        return
+    stmt = insert(Lyrics).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['song', 'artist'],
+        set_={'lyrics': stmt.excluded.lyrics},
+    )
+    with Session(lyrics_db.get_engine()) as session:
+        session.exec(stmt)
+        session.commit()
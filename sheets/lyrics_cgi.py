@@ -3,7 +3,7 @@
 import os
 import sys
 from urllib.parse import parse_qs
-from lyrics_utils import input_form, do_fetch_setlist, format_setlist
+from lyrics_utils import input_form, do_fetch_setlist_sync, format_setlist
 
 from set_utils import find_set
 
@@ -38,7 +38,7 @@ def main():
     if date:
         rows = find_set(None, None, None, date)
 
-    lyrics = do_fetch_setlist(setlist_str, html is None)
+    lyrics = do_fetch_setlist_sync(setlist_str, html is None)
     print(format_setlist(lyrics, html is not None))
 
 
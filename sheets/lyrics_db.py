@@ -0,0 +1,16 @@
+from sqlmodel import SQLModel, create_engine
+import functools
+import config
+
+
+@functools.cache
+def get_engine():
+    # tables for any models imported so far are created on first use, so
+    # command line tools get them without going through the server's
+    # lifespan hook
+    engine = create_engine(
+        f'sqlite:///{config.SQLITE_FILE}',
+        connect_args={'check_same_thread': False},
+    )
+    SQLModel.metadata.create_all(engine)
+    return engine
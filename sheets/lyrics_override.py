@@ -0,0 +1,70 @@
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class OverrideIndex:
+    '''
+    Index of hand-made lyrics files, named "<artist>-<song>.txt", in one
+    directory.  The directory is scanned once and rescanned only when its
+    mtime changes (checked at most every check_interval seconds), so a
+    lookup that misses costs no filesystem calls.  Files are found by
+    their exact name, else by key(song, artist) of the name split at
+    each '-', so "the beatles-let it be.txt" serves "Let It Be, Beatles"
+    if key normalizes those the same.
+    '''
+    def __init__(self, path: str, key, check_interval: float):
+        self.path = path
+        self.key = key
+        self.check_interval = check_interval
+        self.exact: dict[str, str] = {}
+        self.normalized: dict[tuple, str] = {}
+        self.mtime: int | None = None
+        self.checked = -check_interval
+
+    def scan(self):
+        exact = {}
+        normalized = {}
+        try:
+            names = sorted(e.name for e in os.scandir(self.path) if e.name.endswith('.txt') and e.is_file())
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            stem = name.removesuffix('.txt')
+            path = os.path.join(self.path, name)
+            exact[stem] = path
+            # artist or song may contain '-' too; index every split
+            for i, c in enumerate(stem):
+                if c == '-':
+                    normalized.setdefault(self.key(stem[i + 1:], stem[:i]), path)
+        self.exact = exact
+        self.normalized = normalized
+        log.info(f'{len(exact)} lyrics overrides in {self.path}')
+
+    def maybe_refresh(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.scan()
+
+    def lookup(self, song: str, artist: str) -> str | None:
+        self.maybe_refresh()
+        path = self.exact.get(f'{artist}-{song}') or self.normalized.get(self.key(song, artist))
+        if path is None:
+            return None
+        try:
+            with open(path, 'r') as f:
+                log.info(f'override found: {path}')
+                return f.read()
+        except FileNotFoundError:
+            # removed since the last scan
+            return None
@@ -1,12 +1,25 @@
-from fastapi import FastAPI, Response
-from fastapi.responses import PlainTextResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, HTMLResponse, StreamingResponse
 
-from lyrics_utils import do_fetch_setlist, format_setlist, input_form
+from lyrics_utils import (
+    close_client, do_fetch_setlist, format_footer, format_header,
+    format_lyrics, format_setlist, input_form, iter_fetch_setlist,
+)
 import set_utils
 
-from sqlmodel import SQLModel, create_engine, Field, Session, select
+from sqlmodel import SQLModel
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+import asyncio
 import config
+import hashlib
+import json
+import lyrics_cache
+import lyrics_db
+import prefetch
+import sets_search
+import sqlite3
+import time
 
 import logging
 import sys
@@ -19,34 +32,145 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
-class Lyrics(SQLModel, table=True):
-    song: str = Field(primary_key=True)
-    artist: str = Field(primary_key=True)
-    lyrics: str
+engine = lyrics_db.get_engine()
+
+
+class LRUCache:
+    '''
+    In-memory LRU of str values bounded by entry count and total size
+    '''
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> str | None:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: str):
+        if key in self.entries:
+            self.nbytes -= len(self.entries.pop(key).encode())
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.nbytes += size
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= len(old.encode())
+
+    def stats(self) -> dict:
+        return dict(
+            entries=len(self.entries),
+            bytes=self.nbytes,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+# lyrics by (song, artist), in front of the Lyrics table
+hot_lyrics = LRUCache(config.HOT_LYRICS_MAX_ENTRIES, config.HOT_LYRICS_MAX_BYTES)
+
+# rendered response bodies by (page key, etag)
+rendered_pages = LRUCache(config.RENDERED_PAGES_MAX_ENTRIES, config.RENDERED_PAGES_MAX_BYTES)
 
-sqlite_url = f"sqlite:///{config.SQLITE_FILE}"
 
-engine = create_engine(sqlite_url)
+def cached_page(request: Request, key: tuple, content, render, response_class=HTMLResponse) -> Response:
+    '''
+    Respond with render()'s output for the page identified by key, whose
+    output depends only on content.  The ETag is a hash of content, so
+    it changes (and the old rendering is no longer used) whenever the
+    rows or lyrics do; a matching If-None-Match gets a 304.
+    '''
+    digest = hashlib.sha256(json.dumps([key, content]).encode()).hexdigest()
+    etag = f'"{digest}"'
+    headers = {'ETag': etag}
+
+    if_none_match = request.headers.get('if-none-match', '')
+    if etag in [t.strip().removeprefix('W/') for t in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+
+    body = rendered_pages.get((key, etag))
+    if body is None:
+        body = render()
+        rendered_pages.put((key, etag), body)
+    response = response_class(content=body, headers=headers)
+    response.charset = 'utf-8'
+    return response
+
+# set rows by (sheetid, date): (time read, rows)
+recent_sets: OrderedDict = OrderedDict()
+
+
+async def find_set(sheetid: str | None, date: str | None) -> list[dict]:
+    '''
+    set_utils.find_set's rows, reread at most every config.SET_ROWS_TTL
+    seconds so a page being polled (If-None-Match) costs no Sheets reads.
+    The read is off the event loop and doesn't wait for the Sheets read
+    quota: if it's used up the last rows read are served however old, or
+    failing that the page gets a 503.
+    '''
+    key = (sheetid, date)
+    now = time.monotonic()
+    recent = recent_sets.get(key)
+    if recent is not None and now - recent[0] < config.SET_ROWS_TTL:
+        return [dict(r) for r in recent[1]]
+    try:
+        rows = await asyncio.to_thread(set_utils.find_set, sheetid, None, date, wait=False)
+    except set_utils.RateLimited as err:
+        if recent is not None:
+            log.info(f'{err}: Sheets reads rate limited, serving rows {now - recent[0]:.0f}s old')
+            return [dict(r) for r in recent[1]]
+        log.warning(f'{err}: Sheets reads rate limited')
+        raise HTTPException(status_code=503, detail='Sheets reads rate limited; try again shortly',
+                            headers={'Retry-After': str(config.SHEETS_RETRY_AFTER)})
+    recent_sets[key] = (now, rows)
+    recent_sets.move_to_end(key)
+    while len(recent_sets) > config.SET_ROWS_MAX_ENTRIES:
+        recent_sets.popitem(last=False)
+    return [dict(r) for r in rows]
 
 # arrange for the DB to be created on app startup
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     SQLModel.metadata.create_all(engine)
+    prefetcher = None
+    if config.PREFETCH_INTERVAL > 0:
+        # fill the lyrics cache for upcoming sets in the background
+        prefetcher = asyncio.create_task(prefetch.prefetch_forever(
+            config.PREFETCH_DAYS_AHEAD, config.PREFETCH_DAYS_BACK, config.PREFETCH_INTERVAL
+        ))
     yield
+    if prefetcher is not None:
+        prefetcher.cancel()
+        await asyncio.gather(prefetcher, return_exceptions=True)
+    await close_client()
 
 app = FastAPI(lifespan=lifespan)
 
 @app.get('/lyrics')
 async def do_lyrics(
+    request: Request,
     setlist: str|None = None,
     date: str|None = None,
     html: str|None = None,
     sheetid: str|None = None,
     seq: str|None = None,
+    stream: str|None = None,
     ) -> Response:
 
     dohtml:bool = html is not None
     doseq:bool = seq is not None
+    dostream:bool = stream is not None
 
     if not (setlist or date or sheetid):
         response = HTMLResponse(input_form('/lyrics', dateonly=False))
@@ -54,7 +178,7 @@ async def do_lyrics(
 
     set_with_lyrics: list[dict] = []
     if date or sheetid:
-        rows = set_utils.find_set(sheetid, None, date)
+        rows = await find_set(sheetid, date)
         if not rows:
             dialog = f'<script>alert("Oops, no set found for {date}")</script>'
             return HTMLResponse(content=dialog)
@@ -69,53 +193,94 @@ async def do_lyrics(
             song, artist = sl.split(',')
             set_with_lyrics.append({'song':song, 'artist':artist, 'lyrics': None})
 
-    # load any cached lyrics
-    with Session(engine) as session:
+    # load any cached lyrics, from memory if we can, else from the DB
+    missing = []
+    for row in set_with_lyrics:
+        key = (row['song'], row['artist'])
+        if (lyrics := hot_lyrics.get(key)) is not None:
+            row['lyrics'] = lyrics
+        else:
+            missing.append(key)
+    if missing:
+        cached = lyrics_cache.get_lyrics(missing)
         for row in set_with_lyrics:
-            song, artist = row['song'], row['artist']
-            results = session.exec(
-                select(Lyrics).where(
-                    Lyrics.song == song and
-                    Lyrics.artist == artist
-                )
-            )
-            if newlyrobj := results.one_or_none():
+            key = song, artist = row['song'], row['artist']
+            if row['lyrics'] is None and key in cached:
                 log.info(f'found cached lyrics for {song}, {artist}')
-                row['lyrics'] = newlyrobj.lyrics
+                row['lyrics'] = cached[key]
+                hot_lyrics.put(key, cached[key])
 
     if all([r["lyrics"] is not None for r in set_with_lyrics]):
         log.info("all lyrics cached, skipping fetch")
         failures = None
         fetched_set = set_with_lyrics
+    elif dostream:
+        return StreamingResponse(
+            stream_lyrics(set_with_lyrics, dohtml),
+            media_type='text/html; charset=utf-8',
+        )
     else:
-        failures, fetched_set = do_fetch_setlist(set_with_lyrics)
+        failures, fetched_set = await do_fetch_setlist(set_with_lyrics)
 
         # save any lyrics we just got
-        with Session(engine) as session:
-            for row, newrow in zip(set_with_lyrics, fetched_set):
-                if row['lyrics'] is None and newrow['lyrics'] is not None:
-                    log.info(f'got new lyrics for {newrow["song"]} {newrow["artist"]}')
-                    session.add(Lyrics(
-                        song=newrow['song'],
-                        artist=newrow['artist'],
-                        lyrics=newrow['lyrics']
-                    ))
-            session.commit()
-
-    formatted_lyrics = format_setlist(fetched_set, dohtml)
-
-    if failures:
-        failures = '\\n'.join((['NOT_FOUND:\\n'] + failures))
-        dialog = f'<script>alert("{failures}")</script>'
-    else:
-        dialog = ''
-    response = HTMLResponse(content=dialog + formatted_lyrics)
-    response.charset = 'utf-8'
-    return response
+        newrows = []
+        for row, newrow in zip(set_with_lyrics, fetched_set):
+            if row['lyrics'] is None and newrow['lyrics'] is not None:
+                log.info(f'got new lyrics for {newrow["song"]} {newrow["artist"]}')
+                newrows.append(newrow)
+                hot_lyrics.put((newrow['song'], newrow['artist']), newrow['lyrics'])
+        lyrics_cache.put_lyrics(newrows)
+
+    def render():
+        return failure_dialog(failures) + format_setlist(fetched_set, dohtml)
+
+    # failures follow from which songs have no lyrics, so rows are enough
+    key = ('lyrics', date, sheetid, setlist, dohtml, doseq)
+    return cached_page(request, key, fetched_set, render)
+
+
+def failure_dialog(failures: list[str] | None) -> str:
+    if not failures:
+        return ''
+    failure_lines = '\\n'.join((['NOT_FOUND:\\n'] + failures))
+    return f'<script>alert("{failure_lines}")</script>'
+
+
+async def stream_lyrics(set_with_lyrics: list[dict], dohtml: bool):
+    '''
+    Generate the /lyrics page a song at a time, in setlist order, as the
+    lyrics come in; the not-found alert comes last
+    '''
+    yield format_header(dohtml)
+
+    failures = []
+    newrows = []
+    async for index, song, artist, lyrics in iter_fetch_setlist(set_with_lyrics):
+        if set_with_lyrics[index]['lyrics'] is None:
+            if lyrics is None:
+                failures.append(f'{song} - {artist}')
+            else:
+                log.info(f'got new lyrics for {song} {artist}')
+                newrows.append({'song': song, 'artist': artist, 'lyrics': lyrics})
+                hot_lyrics.put((song, artist), lyrics)
+        yield format_lyrics(song, artist, lyrics, dohtml)
+
+    lyrics_cache.put_lyrics(newrows)
+    yield format_footer(dohtml)
+    yield failure_dialog(failures)
+
+
+@app.get('/cache_stats')
+async def do_cache_stats() -> dict:
+    return {
+        'hot_lyrics': hot_lyrics.stats(),
+        'rendered_pages': rendered_pages.stats(),
+    }
 
 
 @app.get('/setlist')
 async def do_setlist(
+    request: Request,
     date: str|None = None,
     sheetid: str|None = None,
     ) -> Response:
@@ -123,7 +288,7 @@ async def do_setlist(
     if not (date or sheetid):
         return HTMLResponse(input_form('/setlist', dateonly=True))
 
-    rows = set_utils.find_set(sheetid, None, date)
+    rows = await find_set(sheetid, date)
     if not rows:
         dialog = f'<script>alert("Oops, no set found for {date}")</script>'
         return HTMLResponse(content=dialog)
@@ -133,13 +298,42 @@ async def do_setlist(
             return f'"{s}"'
         return s
 
-    setlist = [
-        f'{poss_quote(row.get("song"))},{poss_quote(row.get("artist"))}' for row in rows
-    ]
-    setlist.append('')
-    setlist.extend([f'{row.get("artist")} - {row.get("song")}' for row in rows])
-    setlist.append('')
+    def render():
+        setlist = [
+            f'{poss_quote(row.get("song"))},{poss_quote(row.get("artist"))}' for row in rows
+        ]
+        setlist.append('')
+        setlist.extend([f'{row.get("artist")} - {row.get("song")}' for row in rows])
+        setlist.append('')
+        return '\n'.join(setlist)
 
-    response = PlainTextResponse(content='\n'.join(setlist))
-    response.charset = 'utf-8'
-    return response
+    key = ('setlist', date, sheetid)
+    return cached_page(request, key, rows, render, PlainTextResponse)
+
+
+@app.get('/search')
+def do_search(
+    q: str = '',
+    vocal: str|None = None,
+    guitar1: str|None = None,
+    guitar2: str|None = None,
+    bass: str|None = None,
+    drums: str|None = None,
+    keys: str|None = None,
+    page: int = 1,
+    per_page: int = 20,
+    order: str = 'rank',
+    ) -> dict:
+
+    musicians = dict(vocal=vocal, guitar1=guitar1, guitar2=guitar2, bass=bass, drums=drums, keys=keys)
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 200)
+    try:
+        rows = sets_search.search(q, musicians, limit=per_page, offset=(page - 1) * per_page, order=order)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.OperationalError as e:
+        # no sets.db yet, or every connection busy
+        log.warning(f'search failed: {e}')
+        raise HTTPException(status_code=503, detail=str(e))
+    return {'page': page, 'per_page': per_page, 'results': rows}
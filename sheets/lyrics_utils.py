@@ -1,20 +1,36 @@
+import asyncio
 import csv
+import importlib.util
+import json
 import re
 import httpx
 import sys
 import time
 import urllib.parse
 from subprocess import Popen, PIPE
-from concurrent.futures import ThreadPoolExecutor, Future
-from typing import Tuple
+from typing import NamedTuple, Tuple
 from copy import deepcopy
+import api_cache
 import config
 import logging
+import lyrics_override
+import normalize
 
 log = logging.getLogger(__name__)
 
 SEPARATOR = f'\n{"=" * 30}\n'
 
+LRCLIB_API = 'https://lrclib.net/api/'
+
+# one pooled client per event loop; connections are bound to the loop
+# that opened them, so a client can't be shared across asyncio.run()s
+_client: httpx.AsyncClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+# loop used by the sync wrappers, kept so its client (and pool) survive
+# between calls
+_sync_loop: asyncio.AbstractEventLoop | None = None
+
 
 re_subs_artist = [
     # remove any comment
@@ -65,101 +81,197 @@ extra_params = [
 ]
 
 
-def cleanup(which, s):
-    if which == 'song':
-        re_subs = re_subs_song
-    elif which == 'artist':
-        re_subs = re_subs_artist
-    else:
-        return s
-
-    for search, replace in re_subs:
-        s = re.sub(search, replace, s)
-    return s
+# the tables above, compiled
+normalizers = {
+    'song': normalize.Normalizer(re_subs_song),
+    'artist': normalize.Normalizer(re_subs_artist),
+}
+extra_params_index = normalize.MatchIndex(extra_params)
 
 
-def fetch_and_retry(song: str, artist:str) -> str | None:
+def cleanup(which, s):
+    if which not in normalizers:
+        return s
+    return normalizers[which](s)
+
+def override_key(song, artist):
+    # as cleanup() sees them, ignoring case and spacing
+    return (
+        ' '.join(cleanup('song', song).split()).casefold(),
+        ' '.join(cleanup('artist', artist).split()).casefold(),
+    )
+
+overrides = lyrics_override.OverrideIndex(
+    config.LYRICS_OVERRIDE_DIR, override_key, config.LYRICS_OVERRIDE_CHECK_INTERVAL
+)
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            base_url=LRCLIB_API,
+            # HTTP/2 needs the optional h2 package
+            http2=importlib.util.find_spec('h2') is not None,
+            limits=httpx.Limits(
+                max_connections=config.LRCLIB_MAX_CONNECTIONS,
+                max_keepalive_connections=config.LRCLIB_MAX_CONNECTIONS,
+                keepalive_expiry=config.LRCLIB_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(config.LRCLIB_TIMEOUT),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client = _client_loop = None
+
+
+def run_sync(coro):
+    global _sync_loop
+    if _sync_loop is None or _sync_loop.is_closed():
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
+
+class Probe(NamedTuple):
+    song: str
+    artist: str
+    extra: tuple | None = None
+    # api/search for song, matching artist in the results
+    search: bool = False
+
+
+def candidate_probes(song: str, artist: str) -> list[tuple[Probe, ...]]:
+    '''
+    Return the lookups fetch_and_retry tries for song/artist, in priority
+    order.  Each entry is a tuple of probes that must all find lyrics; more
+    than one means the lyrics are joined with SEPARATOR.
+    '''
     # first add any extra params if we know it'll help isolate the
     # particular song we want
 
-    extra = None
-    for extra_entry in extra_params:
-        if re.match(extra_entry[0], song) and re.match(extra_entry[1], artist):
-            extra = extra_entry[2]
+    extra = extra_params_index.lookup(song, artist)
 
-    if lyrics := fetch_lyrics(song, artist, extra):
-        return lyrics
+    steps: list[tuple[Probe, ...]] = [(Probe(song, artist, extra),)]
 
     #
     # various heuristics to try to cope with special situations
     #
     # 0) try cleanup(song) and try adding cleanup(artist)
     song = cleanup('song', song)
-    if lyrics := fetch_lyrics(song, artist):
-        return lyrics
+    steps.append((Probe(song, artist),))
 
     artist = cleanup('artist', artist)
-    if lyrics := fetch_lyrics(song, artist):
-        return lyrics
+    steps.append((Probe(song, artist),))
 
     # 1) try prepending 'The ' to the artist name
-    new_artist = 'The ' + artist
-    if (lyrics := fetch_lyrics(song, new_artist)):
-        return lyrics
+    steps.append((Probe(song, 'The ' + artist),))
 
     # 2) try removing 'The ' from the song
-    new_song = re.sub('^The ', '', song)
-    if (lyrics := fetch_lyrics(new_song, artist)):
-        return lyrics
+    steps.append((Probe(re.sub('^The ', '', song), artist),))
 
     # 3) look for '/' in title, try two fetches for two titles
-    found = 0
     if '/' in song:
-        combined_lyrics = list()
-        songs = song.split('/')
-        for s in songs:
-            if (lyrics := fetch_lyrics(s, artist)):
-                found += 1
-                combined_lyrics.append(lyrics)
-        if found and found == len(songs):
-            return SEPARATOR.join(combined_lyrics)
+        steps.append(tuple(Probe(s, artist) for s in song.split('/')))
 
     # 4) look for '/' in artist, try each artist
     if '/' in artist:
-        artists = artist.split('/')
-        for a in artists:
-            if (lyrics := fetch_lyrics(song, a)):
-                return lyrics
+        steps.extend((Probe(song, a),) for a in artist.split('/'))
 
     # 5) look for 'and' in artist, truncate before (for songs like
     # 'artist and guest artist' (rather than bands like Sam and Dave))
     if 'and' in artist:
-        new_artist = re.sub(r'(.*) and.*', r'\1', artist)
-        if lyrics := fetch_lyrics(song, new_artist):
-            return lyrics
+        steps.append((Probe(song, re.sub(r'(.*) and.*', r'\1', artist)),))
 
     # 6) look for '/' in both title and artist, try splitting both
-    found = 0
     if '/' in song and '/' in artist:
-        combined_lyrics = list()
         songs = song.split('/')
         artists = artist.split('/')
         if len(songs) == len(artists):
-            for s, a in zip(songs, artists):
-                if (lyrics := fetch_lyrics(s, a)):
-                    found += 1
-                    combined_lyrics.append(lyrics)
-            if found and found == len(songs):
-                return SEPARATOR.join(combined_lyrics)
+            steps.append(tuple(Probe(s, a) for s, a in zip(songs, artists)))
 
     # 7) long shot: try api/search for the song string, and look for a
     # matching artist in the returned JSON, like for "(The Angels Wanna
     # Wear My) Red Shoes", which will end up having been cleaned up to
     # "Red Shoes".  Also, when matching artist, first look for exact
     # match, then look for 'artist' as substring of db artist.
-    lyrics = search_song(song, artist)
+    steps.append((Probe(song, artist, search=True),))
+
+    # the same lookup often shows up more than once (cleanup() was a
+    # no-op, say); only keep its first appearance as a single-probe step
+    seen: set[tuple[Probe, ...]] = set()
+    unique_steps = []
+    for step in steps:
+        if step not in seen:
+            seen.add(step)
+            unique_steps.append(step)
+    return unique_steps
+
+
+async def run_probe(probe: Probe) -> str | None:
+    if probe.search:
+        return await search_song(probe.song, probe.artist)
+    return await fetch_lyrics(probe.song, probe.artist, probe.extra)
+
+
+async def fetch_and_retry(song: str, artist:str, fanout: int = config.PROBE_FANOUT) -> str | None:
+    '''
+    Try each candidate lookup for song/artist and return the lyrics from
+    the first (in priority order) that succeeds.  With fanout > 1, up to
+    that many lookups are run concurrently, and any still outstanding are
+    cancelled once the answer is known.
+    '''
+    # a local override wins before anything goes out
+    if song and artist and (lyrics := fetch_override(song, artist)):
+        return lyrics
+
+    steps = candidate_probes(song, artist)
+    results: dict[Probe, asyncio.Future] = {}
+
+    if fanout > 1:
+        sem = asyncio.Semaphore(fanout)
+
+        async def bounded_probe(probe):
+            async with sem:
+                return await run_probe(probe)
+
+        # create tasks in priority order so the semaphore hands out slots
+        # to the most likely answers first
+        for step in steps:
+            for probe in step:
+                if probe not in results:
+                    results[probe] = asyncio.ensure_future(bounded_probe(probe))
+
+    async def result(probe):
+        if probe not in results:
+            results[probe] = asyncio.ensure_future(run_probe(probe))
+        return await results[probe]
+
+    try:
+        for step in steps:
+            found = []
+            for probe in step:
+                if not (lyrics := await result(probe)):
+                    break
+                found.append(lyrics)
+            else:
+                return SEPARATOR.join(found)
+        return None
+    finally:
+        for f in results.values():
+            f.cancel()
+        # reap everything so no exception goes unretrieved
+        await asyncio.gather(*results.values(), return_exceptions=True)
+
 
-    return lyrics
+def fetch_and_retry_sync(song: str, artist: str) -> str | None:
+    return run_sync(fetch_and_retry(song, artist))
 
 
 def fetch_override(song, artist, extra=None):
@@ -169,28 +281,38 @@ def fetch_override(song, artist, extra=None):
         return None
     return resp.text
     '''
-    try:
-        name=f'/var/www/html/lyrics-override/{artist}-{song}.txt'
-        f = open(name, 'r')
-        log.info(f'override found: {name}')
-        return f.read()
-    except FileNotFoundError:
-        pass
-
-
-def fetch_api_path(path):
-    url = f'https://lrclib.net/api/{path}'
-    resp = httpx.get(url)
-    if resp.status_code == 404:
+    return overrides.lookup(song, artist)
+
+
+async def fetch_api_path(path):
+    # answer from the response cache when we can; misses are cached too.
+    # The cache is SQLite, so it's read and written off the event loop
+    key = api_cache.normalize_path(path)
+    if cached := await asyncio.to_thread(api_cache.lookup, key):
+        status, body = cached
+    else:
+        try:
+            resp = await get_client().get(path)
+        except httpx.HTTPError as err:
+            # timed out, connection refused...: a failed lookup too
+            log.info(f'{path}: {type(err).__name__} {err}')
+            return None
+        status, body = resp.status_code, resp.text
+        if status not in api_cache.CACHEABLE_STATUSES:
+            # rate limited, server trouble...: a failed lookup, not an answer
+            log.info(f'{path}: status {status}')
+            return None
+        await asyncio.to_thread(api_cache.store, key, status, body)
+    if status == 404:
         return None
-    j = resp.json()
-    if resp.status_code == 400:
+    j = json.loads(body)
+    if status == 400:
         log.info(f'{j["name"]}: {j["message"]}')
         return None
-    return resp
+    return j
 
 
-def fetch_lyrics(song, artist, extra=None):
+async def fetch_lyrics(song, artist, extra=None):
     if not song or not artist:
         return f'<incomplete request {song=} {artist=}>'
 
@@ -202,31 +324,24 @@ def fetch_lyrics(song, artist, extra=None):
     quoted_artist = urllib.parse.quote_plus(artist)
     quoted_song = urllib.parse.quote_plus(song)
 
-    # look for local override for custom/unfindable lyrics
-    resp = fetch_override(song, artist, extra)
-    if resp:
-        return resp
-
     api_path = f'get?artist_name={quoted_artist}&track_name={quoted_song}'
     if extra:
         if extra[0] == 'id':
             api_path=f'get/{extra[1]}'
         else:
             api_path += f'&{extra[0]}={urllib.parse.quote_plus(extra[1])}'
-    resp = fetch_api_path(api_path)
+    j = await fetch_api_path(api_path)
 
-    if resp:
-        j = resp.json()
+    if j:
         if j['instrumental']:
             return '<Instrumental>'
         return j['plainLyrics']
 
 
-def search_song(song, artist):
+async def search_song(song, artist):
     quoted_search = urllib.parse.quote_plus(song)
-    resp = fetch_api_path(f'search?track_name={quoted_search}')
-    if resp:
-        matches = resp.json()
+    matches = await fetch_api_path(f'search?track_name={quoted_search}')
+    if matches:
         for m in matches:
             if m['artistName'] == artist:
                 return m['plainLyrics']
@@ -243,55 +358,76 @@ def format_lyrics(song, artist, lyrics, html):
         lyrics = f'{SEPARATOR}\n*** {song} - {artist}: Lyrics not found ***\n'
 
     if html:
-        html_lyrics = ''
+        html_lyrics = []
         for l in lyrics.split('\n'):
             l = l.strip()
             if not len(l):
                 l = '&nbsp'
-            html_lyrics += f'<p>{l}</p>\n'
-        return html_lyrics
+            html_lyrics.append(f'<p>{l}</p>\n')
+        return ''.join(html_lyrics)
     else:
         return lyrics
 
 
-def format_setlist(setlist: list[dict], html:bool = False) -> str:
+def format_header(html:bool = False) -> str:
+    if html:
+        return f'{config.HEADER}\n{config.CSS}\n{config.SCROLL_SCRIPT}\n'
+    return '<pre>\n'
 
-    retstr = ''
+
+def format_footer(html:bool = False) -> str:
     if html:
-        retstr = f'{config.HEADER}\n{config.CSS}\n{config.SCROLL_SCRIPT}\n'
-    else:
-        retstr = '<pre>\n'
+        return f'{config.FOOTER}\n'
+    return '</pre>\n'
 
+
+def format_setlist(setlist: list[dict], html:bool = False) -> str:
+
+    parts = [format_header(html)]
     for row in setlist:
-        retstr += format_lyrics(row['song'], row['artist'], row['lyrics'], html)
+        parts.append(format_lyrics(row['song'], row['artist'], row['lyrics'], html))
+    parts.append(format_footer(html))
+    return ''.join(parts)
 
-    if html:
-        retstr += f'{config.FOOTER}\n'
-    else:
-        retstr += '</pre>\n'
-    return retstr
 
+async def iter_fetch_setlist(setlist:list[dict]):
+    '''
+    Search for any song in setlist that does not already have lyrics, and
+    yield (index, song, artist, lyrics) for every row in setlist order, each
+    as soon as it and all the rows before it are done
+    '''
+    tasks = {}
+    for index, row in enumerate(setlist):
+        song, artist = row['song'], row['artist']
+        if row.get('lyrics'):
+            log.info(f'already have lyrics for {song} {artist}')
+            continue
+        log.info(f'do_fetch_setlist looking for {song} {artist}')
+        tasks[index] = asyncio.ensure_future(do_fetch_song(index, song, artist))
+
+    try:
+        for index, row in enumerate(setlist):
+            if index in tasks:
+                yield await tasks[index]
+            else:
+                yield index, row['song'], row['artist'], row['lyrics']
+    finally:
+        # if the consumer goes away, so does the work
+        for t in tasks.values():
+            t.cancel()
 
-def do_fetch_setlist(setlist:list[dict], html=False) -> Tuple[list[str], list[dict]]:
-    __doc__= '''
+
+async def do_fetch_setlist(setlist:list[dict], html=False) -> Tuple[list[str], list[dict]]:
+    '''
     For any song in setlist that does not already have lyrics, search for it
     and return a list of failures in the form 'Song - Artist', and a copy
     of setlist with the missing lyrics filled in
     '''
     ret: list[dict] = deepcopy(setlist)
-    futures = []
-    with ThreadPoolExecutor(max_workers=20) as e:
-        for index, row in enumerate(setlist):
-            song, artist = row['song'], row['artist']
-            if row.get('lyrics'):
-                log.info(f'already have lyrics for {song} {artist}')
-                continue
-            log.info(f'do_fetch_setlist looking for {song} {artist}')
-            futures.append(e.submit(do_fetch_song, index, song, artist))
-
     failures: list[str] = []
-    for f in futures:
-        index, song, artist, lyrics = f.result()
+    async for index, song, artist, lyrics in iter_fetch_setlist(setlist):
+        if setlist[index].get('lyrics'):
+            continue
         ret[index]['lyrics'] = lyrics
         if not lyrics:
             log.info(f'failed to find {song} {artist}')
@@ -302,10 +438,14 @@ def do_fetch_setlist(setlist:list[dict], html=False) -> Tuple[list[str], list[di
     return failures, ret
 
 
-def do_fetch_song(index: int, song:str, artist:str) -> Tuple[int, str, str, str|None]:
+def do_fetch_setlist_sync(setlist:list[dict], html=False) -> Tuple[list[str], list[dict]]:
+    return run_sync(do_fetch_setlist(setlist, html))
+
+
+async def do_fetch_song(index: int, song:str, artist:str) -> Tuple[int, str, str, str|None]:
     # returns song, artist so that when used concurrently one can tie
     # the return value to the request
-    lyrics = fetch_and_retry(song, artist)
+    lyrics = await fetch_and_retry(song, artist)
     return index, song, artist, lyrics
 
 
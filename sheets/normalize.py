@@ -0,0 +1,126 @@
+import functools
+import re
+
+# characters that make a pattern more than a literal string
+REGEX_SPECIALS = set('.^$*+?{}[]\\|()')
+
+
+def is_literal(pattern: str) -> bool:
+    return not any(c in REGEX_SPECIALS for c in pattern)
+
+
+def overlaps(a: str, b: str) -> bool:
+    # could a match of one string share any characters with the other?
+    if a in b or b in a:
+        return True
+    for n in range(1, min(len(a), len(b))):
+        if a.endswith(b[:n]) or b.endswith(a[:n]):
+            return True
+    return False
+
+
+def can_merge(run: list[tuple[str, str]], pattern: str, replace: str) -> bool:
+    '''
+    Can (pattern, replace) join run, a list of literal rewrites applied in
+    order, so that one pass of an alternation gives the same result as
+    applying them one after another?  Only if no two patterns overlap
+    (they can't compete for the same text) and pattern can't overlap any
+    earlier replacement in the run (an earlier rewrite can't create a
+    match for it).
+    '''
+    if not replace:
+        # removing text can join its neighbours into a new match
+        return False
+    for p, r in run:
+        if overlaps(p, pattern) or overlaps(r, pattern):
+            return False
+    return True
+
+
+class Normalizer:
+    '''
+    Applies a table of (pattern, replacement) re.sub rewrites in order, as
+    if by calling re.sub for each one, but with the patterns compiled once,
+    runs of literal substitutions that can't interact folded into a single
+    pass, and results memoized per input string.
+    '''
+    def __init__(self, table: list[tuple[str, str]], cache_size: int = 4096):
+        self.steps = []
+        run: list[tuple[str, str]] = []
+        for pattern, replace in table:
+            if is_literal(pattern) and '\\' not in replace:
+                if can_merge(run, pattern, replace):
+                    run.append((pattern, replace))
+                    continue
+                self._add_literal_run(run)
+                run = [(pattern, replace)]
+                continue
+            self._add_literal_run(run)
+            run = []
+            self.steps.append(functools.partial(re.compile(pattern).sub, replace))
+        self._add_literal_run(run)
+        self.normalize = functools.lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _add_literal_run(self, run: list[tuple[str, str]]):
+        if not run:
+            return
+        if len(run) == 1:
+            pattern, replace = run[0]
+            self.steps.append(lambda s: s.replace(pattern, replace))
+            return
+        replacements = dict(run)
+        alternation = re.compile('|'.join(re.escape(p) for p, _ in run))
+        self.steps.append(
+            functools.partial(alternation.sub, lambda m: replacements[m.group(0)])
+        )
+
+    def _normalize(self, s: str) -> str:
+        for step in self.steps:
+            s = step(s)
+        return s
+
+    def __call__(self, s: str) -> str:
+        return self.normalize(s)
+
+
+def literal_prefix(pattern: str) -> str:
+    # the literal text any re.match of pattern must start with
+    if '|' in pattern:
+        return ''
+    prefix = ''
+    for i, c in enumerate(pattern):
+        if c in REGEX_SPECIALS:
+            # a quantifier makes the character before it optional
+            if c in '*?{':
+                prefix = prefix[:-1]
+            break
+        prefix += c
+    return prefix
+
+
+class MatchIndex:
+    '''
+    Finds the last of a list of (song_pattern, artist_pattern, value)
+    entries whose patterns re.match song and artist, without trying every
+    entry: entries are bucketed by the first character their song pattern
+    requires, and results are memoized.
+    '''
+    def __init__(self, entries: list[tuple[str, str, object]], cache_size: int = 4096):
+        self.buckets: dict[str, list] = {}
+        # entries that could match a song starting with anything
+        self.anywhere = []
+        for pos, (song_re, artist_re, value) in enumerate(entries):
+            entry = (pos, re.compile(song_re), re.compile(artist_re), value)
+            if prefix := literal_prefix(song_re):
+                self.buckets.setdefault(prefix[0], []).append(entry)
+            else:
+                self.anywhere.append(entry)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _lookup(self, song: str, artist: str):
+        candidates = self.buckets.get(song[:1], []) + self.anywhere
+        found = None
+        for pos, song_re, artist_re, value in sorted(candidates, key=lambda e: e[0]):
+            if song_re.match(song) and artist_re.match(artist):
+                found = value
+        return found
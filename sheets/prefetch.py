@@ -0,0 +1,98 @@
+#!/home/dmick/src/jamtools/sheets/v/bin/python3
+
+import argparse
+import asyncio
+import datetime
+import logging
+import sys
+
+import config
+import lyrics_cache
+import lyrics_utils
+import set_utils
+
+log = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Fill the lyrics cache for sets coming up (and just '
+                    'past), so their /lyrics pages need no lookups')
+    parser.add_argument('-a', '--ahead', type=int, default=config.PREFETCH_DAYS_AHEAD, help='days ahead to look')
+    parser.add_argument('-b', '--back', type=int, default=config.PREFETCH_DAYS_BACK, help='days back to look')
+    parser.add_argument('-i', '--interval', type=float, default=config.PREFETCH_INTERVAL,
+                        help='seconds between passes; 0 for just one')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def date_int(d: datetime.date) -> int:
+    return int(d.strftime('%Y%m%d'))
+
+
+def sets_around(today: datetime.date, ahead: int, back: int) -> list[tuple[str, str]]:
+    # (sheetdate, sheetid) of the sets from back days ago through ahead
+    # days from now
+    index = set_utils.get_set_index()
+    start = today - datetime.timedelta(days=back)
+    end = today + datetime.timedelta(days=ahead)
+    return index.between(date_int(start), date_int(end))
+
+
+async def prefetch_once(ahead: int, back: int) -> int:
+    '''
+    Look up lyrics for every song in the sets around today that isn't in
+    the Lyrics cache, one song at a time with config.PREFETCH_PAUSE
+    seconds between, so pages being served come first.  The sets are
+    reread each time, so edits to them are picked up.  Returns the
+    number of songs newly cached.
+    '''
+    # the index and sheets come from the (blocking) Sheets API
+    sets = await asyncio.to_thread(sets_around, datetime.date.today(), ahead, back)
+    found = 0
+    for sheetdate, sheetid in sets:
+        rows = await asyncio.to_thread(set_utils.get_rows, sheetdate, sheetid)
+        pairs = list({(r['song'], r['artist']) for r in rows if r.get('song') and r.get('artist')})
+        cached = lyrics_cache.get_lyrics(pairs)
+        missing = [p for p in pairs if p not in cached]
+        log.info(f'prefetch {sheetdate}: {len(pairs)} songs, {len(missing)} not cached')
+        for song, artist in missing:
+            _, fetched = await lyrics_utils.do_fetch_setlist([{'song': song, 'artist': artist, 'lyrics': None}])
+            if fetched[0]['lyrics']:
+                lyrics_cache.put_lyrics(fetched)
+                found += 1
+            await asyncio.sleep(config.PREFETCH_PAUSE)
+    return found
+
+
+async def prefetch_forever(ahead: int, back: int, interval: float):
+    # for lyrics_server's lifespan: a pass every interval seconds, until
+    # cancelled
+    while True:
+        try:
+            found = await prefetch_once(ahead, back)
+            log.info(f'prefetch cached {found} songs')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('prefetch pass failed')
+        await asyncio.sleep(interval)
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.interval <= 0:
+        found = lyrics_utils.run_sync(prefetch_once(args.ahead, args.back))
+        print(f'cached {found} songs', file=sys.stderr)
+        return 0
+    try:
+        lyrics_utils.run_sync(prefetch_forever(args.ahead, args.back, args.interval))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+#!/home/dmick/src/jamtools/sheets/v/bin/python3
+
+import argparse
+import csv
+import sys
+
+import set_utils
+import sets_search
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Search past sets (sets.db)')
+    parser.add_argument('query', nargs='*', help='words to find (as prefixes) in any field')
+    for column in sets_search.MUSICIAN_COLUMNS:
+        parser.add_argument(f'--{column}', help=f'only sets with this {column} player')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='results per page')
+    parser.add_argument('-p', '--page', type=int, default=1)
+    parser.add_argument('-o', '--order', choices=sets_search.ORDERS.keys(), default='rank')
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    musicians = {c: getattr(args, c) for c in sets_search.MUSICIAN_COLUMNS}
+    try:
+        rows = sets_search.search(
+            ' '.join(args.query), musicians,
+            limit=args.limit, offset=(args.page - 1) * args.limit, order=args.order,
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    fields = set_utils.cleanfields(set_utils.ALLFIELDS)
+    cw = csv.DictWriter(sys.stdout, fields, extrasaction='ignore')
+    cw.writeheader()
+    cw.writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
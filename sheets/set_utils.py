@@ -1,11 +1,17 @@
+import bisect
+import collections
 import datetime
 import google_utils
+import random
 import re
+import threading
 import sys
 import time
 import typing
 import config
 import logging
+import sheet_mirror
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
@@ -38,32 +44,186 @@ def date_to_int(d:str) -> int:
     return date_int
 
 
-def get_and_retry_on_rate_limit(sheetid: str, rng: str) -> list[list[str]]:
-    sheetservice = google_utils.get_sheetservice()
-    sleeptime = 1
-    fail = True
-    while fail:
+# header row and songs of a set sheet, fetched together with batchGet
+SHEET_RANGES = ['C1:L1', 'C3:L']
+
+class RateLimiter:
+    '''
+    Token bucket shared by every thread making Sheets reads: refills at
+    per_minute/60 tokens a second up to burst.  pause() stops everyone
+    for a while, e.g. for a Retry-After.
+    '''
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, n: int = 1, wait: bool = True) -> bool:
+        # with wait False, returns False at once rather than sleeping
+        # until there are tokens (or the pause is over)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # a request bigger than the bucket goes into debt rather
+                # than waiting forever
+                if now >= self.paused_until and self.tokens >= min(n, self.burst):
+                    self.tokens -= n
+                    return True
+                if not wait:
+                    return False
+                delay = max(self.paused_until - now, (min(n, self.burst) - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+read_limiter = RateLimiter(config.SHEETS_READS_PER_MINUTE, config.SHEETS_READ_BURST)
+
+
+class RateLimited(Exception):
+    # a read that would have had to wait for read_limiter, asked not to
+    pass
+
+
+def is_rate_limit(err: Exception) -> bool:
+    return isinstance(err, google_utils.HttpError) and err.resp.status == 429
+
+
+def retry_delay(err: google_utils.HttpError, attempt: int) -> float:
+    # the server's Retry-After if it sent one, else jittered exponential
+    # backoff
+    retry_after = err.resp.get('retry-after')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    return min(config.SHEETS_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def backoff_on_rate_limit(err: Exception, attempt: int, what: str):
+    # raise err unless it's a rate limit we should retry; else hold off
+    # every reader for the delay
+    if not is_rate_limit(err) or attempt >= config.SHEETS_MAX_RETRIES:
+        raise(err)
+    delay = retry_delay(err, attempt)
+    log.info(f'{what} ratelimited; pausing for {delay:.1f} seconds')
+    read_limiter.pause(delay)
+
+
+def execute_and_retry_on_rate_limit(request, what: str, wait: bool = True) -> dict:
+    # wait False: raise RateLimited instead of waiting for read_limiter
+    # (a 429 still pauses everyone else)
+    attempt = 0
+    while True:
+        if not read_limiter.acquire(wait=wait):
+            raise RateLimited(what)
         try:
-            result = sheetservice.values().get(spreadsheetId=sheetid, range=rng).execute()
-            fail = False
+            return request.execute()
         except google_utils.HttpError as err:
-            if '429' not in str(err):
-                raise(err)
-            log.info(f'{sheetid} {rng} ratelimited; pausing for {sleeptime} seconds')
-            time.sleep(sleeptime)
-            sleeptime *= 2
-            continue
+            backoff_on_rate_limit(err, attempt, what)
+            attempt += 1
 
-    result = result.get('values', []) # type: ignore
 
-    return result
+def get_and_retry_on_rate_limit(sheetid: str, rng: str, wait: bool = True) -> list[list[str]]:
+    sheetservice = google_utils.get_sheetservice()
+    result = execute_and_retry_on_rate_limit(
+        sheetservice.values().get(spreadsheetId=sheetid, range=rng),
+        f'{sheetid} {rng}',
+        wait,
+    )
+    return result.get('values', [])
 
 
-def get_rows(sheetdate: str, sheetid: str) -> list[dict[str, str]]:
+def sheet_from_batch(result: dict) -> tuple[list[str], list[list[str]]]:
+    header_range, songs_range = result['valueRanges']
+    header = header_range.get('values', [])[0]
+    songs = songs_range.get('values', [])
+    return header, songs
 
-    # may throw HttpError
-    colnames: list[str]
-    colnames = get_and_retry_on_rate_limit(sheetid, 'C1:L1')[0]
+
+def fetch_sheet(sheetid: str, wait: bool = True) -> tuple[list[str], list[list[str]]]:
+    # raw header row and song rows of a set sheet, in one request
+    # may throw HttpError, or RateLimited if not wait
+    sheetservice = google_utils.get_sheetservice()
+    result = execute_and_retry_on_rate_limit(
+        sheetservice.values().batchGet(spreadsheetId=sheetid, ranges=SHEET_RANGES),
+        sheetid,
+        wait,
+    )
+    return sheet_from_batch(result)
+
+
+def iter_fetch_sheets(sheetids: list[str], workers: int = 1):
+    '''
+    Yield (sheetid, (header, songs)) for each of sheetids, in order.  With
+    workers > 1 sheets are fetched on a pool of that many threads;
+    otherwise config.SHEETS_BATCH_SIZE batchGets at a time are sent in one
+    batch HTTP request.  Either way reads share read_limiter (each request
+    in a batch counts against the quota).
+    '''
+    sheetids = list(dict.fromkeys(sheetids))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as e:
+            yield from zip(sheetids, e.map(fetch_sheet, sheetids))
+        return
+
+    service = google_utils.get_service()
+    for first in range(0, len(sheetids), config.SHEETS_BATCH_SIZE):
+        chunk = sheetids[first:first + config.SHEETS_BATCH_SIZE]
+        results: dict[str, tuple[list[str], list[list[str]]]] = {}
+        attempt = 0
+        while pending := [sheetid for sheetid in chunk if sheetid not in results]:
+            errors: dict[str, Exception] = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[request_id] = exception
+                else:
+                    results[request_id] = sheet_from_batch(response)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for sheetid in pending:
+                batch.add(
+                    service.spreadsheets().values().batchGet(spreadsheetId=sheetid, ranges=SHEET_RANGES),
+                    request_id=sheetid,
+                )
+            read_limiter.acquire(len(pending))
+            batch.execute()
+
+            for err in errors.values():
+                if not is_rate_limit(err):
+                    raise(err)
+            if errors:
+                backoff_on_rate_limit(next(iter(errors.values())), attempt,
+                                      f'{len(errors)} of {len(pending)} sheets')
+                attempt += 1
+
+        for sheetid in chunk:
+            yield sheetid, results[sheetid]
+
+
+def get_rows(sheetdate: str, sheetid: str, mirror=None, wait: bool = True) -> list[dict[str, str]]:
+    # mirror: sheet_mirror connection to read from instead of the API
+    sheet = None
+    if mirror is not None:
+        sheet = sheet_mirror.get_sheet(mirror, sheetid)
+        if sheet is None:
+            log.info(f'{sheetdate} {sheetid} not in mirror, fetching')
+    if sheet is None:
+        sheet = fetch_sheet(sheetid, wait)
+    return parse_rows(sheetdate, *sheet)
+
+
+def parse_rows(sheetdate: str, header: list[str], songs: list[list[str]]) -> list[dict[str, str]]:
+
+    colnames: list[str] = header
 
     # there was at least one setlist with "GUITAR 2 (Elec)".
     # Strip any parenthesized phrases
@@ -96,7 +256,6 @@ def get_rows(sheetdate: str, sheetid: str) -> list[dict[str, str]]:
     ofields = cleanfields(ofields)
 
     rows = []
-    songs = get_and_retry_on_rate_limit(sheetid, 'C3:L')
     for i, s in enumerate(songs):
 
         # make sentinel "no title, artist, or vocalist"
@@ -127,51 +286,128 @@ def get_rows(sheetdate: str, sheetid: str) -> list[dict[str, str]]:
 
     return rows
 
-def find_set(sheetid, start, date):
+class SetIndex:
+    '''
+    The date -> sheetid cross-reference from ALL_SETLISTS_SHEETID, sorted
+    by date for bisect lookups
+    '''
+    def __init__(self, date_and_ids: list[list[str]]):
+        entries = []
+        for pos, idrow in enumerate(date_and_ids):
+            if len(idrow) == 0:
+                break
+            sheetdate, sheetid = idrow
+            entries.append((date_to_int(sheetdate), pos, sheetdate, sheetid))
+        # by date, and sheet order among sets with the same date
+        entries.sort()
+        self.entries = entries
+        self.dates = [e[0] for e in entries]
+        self.created = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+    def lookup(self, date: str) -> tuple[str, str] | None:
+        # (sheetdate, sheetid) of the first set listed for date
+        date_int = date_to_int(date)
+        i = bisect.bisect_left(self.dates, date_int)
+        if i < len(self.dates) and self.dates[i] == date_int:
+            _, _, sheetdate, sheetid = self.entries[i]
+            return sheetdate, sheetid
+        return None
+
+    def between(self, start_int: int | None, end_int: int) -> list[tuple[str, str]]:
+        # (sheetdate, sheetid) of sets from start_int (or the beginning)
+        # through end_int, in sheet order
+        lo = 0 if start_int is None else bisect.bisect_left(self.dates, start_int)
+        hi = bisect.bisect_right(self.dates, end_int)
+        return [(e[2], e[3]) for e in sorted(self.entries[lo:hi], key=lambda e: e[1])]
+
+
+_set_index: SetIndex | None = None
+
+
+def get_set_index(mirror=None, refresh: bool = False, wait: bool = True) -> SetIndex:
+    '''
+    Return the SetIndex, from the mirror connection if given, else from
+    Google, kept for config.SET_INDEX_TTL seconds (or until refresh).
+    With wait False an expired index is kept rather than waiting for
+    read_limiter; RateLimited if there's none to keep.
+    '''
+    global _set_index
+    if mirror is not None:
+        return SetIndex(sheet_mirror.get_index(mirror))
+    if refresh or _set_index is None or _set_index.age() > config.SET_INDEX_TTL:
+        try:
+            _set_index = SetIndex(get_and_retry_on_rate_limit(config.ALL_SETLISTS_SHEETID, 'A:B', wait))
+        except RateLimited:
+            if refresh or _set_index is None:
+                raise
+            log.info('set index expired but reads are rate limited; keeping it')
+    return _set_index
+
+
+def iter_sets(sheetid, start, date, mirror=False, workers=1, wait=True):
+    '''
+    Yield (sheetdate, rows) for each set selected by sheetid/start/date, in
+    index order, as soon as its sheet has been read.  With date, stops
+    after the matching set.
+    mirror: read the index and sheets from the local mirror (see
+    sync_sheets.py) rather than from Google
+    workers: fetch this many sheets at once (see iter_fetch_sheets)
+    wait: with False, a single set (sheetid or date) raises RateLimited
+    rather than waiting for read_limiter
+    '''
+    conn = sheet_mirror.connect() if mirror else None
     now = datetime.datetime.now(tz=datetime.
         timezone(-datetime.timedelta(hours=6)))
     if sheetid:
         date = date or now.strftime("%Y-%m-%d")
-        rows = (get_rows(date, sheetid))
-    else:
-        # get the cross-reference of dates/setlist sheets
-        date_and_ids = get_and_retry_on_rate_limit(config.ALL_SETLISTS_SHEETID, 'A:B')
-
-        startdate_int = -2
-        date_int = -2
-        if start:
-            startdate_int = date_to_int(start)
-        if date:
-            date_int = date_to_int(date)
-        today_int = date_to_int(now.strftime("%Y-%m-%d"))
-
-        rows = []
+        yield date, get_rows(date, sheetid, conn, wait)
+        return
+
+    index = get_set_index(conn, wait=wait)
+    if date:
+        # just return it once found
+        found = index.lookup(date)
+        if found is None and conn is None and index.age() > config.SET_INDEX_MIN_AGE:
+            # maybe it's a set added since we last looked
+            found = get_set_index(refresh=True, wait=wait).lookup(date)
+        if found is not None:
+            sheetdate, sheetid = found
+            yield sheetdate, get_rows(sheetdate, sheetid, conn, wait)
+        return
+
+    # sets from start (or the beginning) through today
+    today_int = date_to_int(now.strftime("%Y-%m-%d"))
+    wanted = index.between(date_to_int(start) if start else None, today_int)
+
+    # fetch whatever the mirror can't supply in batches, a batch at a
+    # time as we get to it
+    mirrored = set(sheet_mirror.get_modified(conn)) if conn is not None else set()
+    fetched = iter_fetch_sheets([i for _, i in wanted if i not in mirrored], workers)
+    # iter_fetch_sheets only fetches a sheet once; hang on to any listed
+    # under more than one date
+    counts = collections.Counter(i for _, i in wanted)
+    repeated: dict[str, tuple[list[str], list[list[str]]]] = {}
+
+    for sheetdate, sheetid in wanted:
+        if sheetid in mirrored:
+            sheet = sheet_mirror.get_sheet(conn, sheetid)
+        elif sheetid in repeated:
+            sheet = repeated[sheetid]
+        else:
+            _, sheet = next(fetched)
+            if counts[sheetid] > 1:
+                repeated[sheetid] = sheet
+        yield sheetdate, parse_rows(sheetdate, *sheet)
 
-        log.info(f'{date_int=}')
-        for idrow in date_and_ids:
-            if len(idrow) == 0:
-                break
 
-            # if date, look for date == args.date, and return that if found
-            # if start, don't output until date is after args.start
-            # if we're here, we didn't have both id and args.date
+def iter_rows(sheetid, start, date, mirror=False, workers=1, wait=True):
+    # the rows of every set from iter_sets, as they arrive
+    for _, rows in iter_sets(sheetid, start, date, mirror, workers, wait):
+        yield from rows
 
-            output = False
-            sheetdate, sheetid = idrow
-            sheetdate_int = date_to_int(sheetdate)
-            # just return it once found
-            if date:
-                if (sheetdate_int == date_int):
-                    return get_rows(sheetdate, sheetid)
-                continue
-
-            if start:
-                output = (sheetdate_int >= startdate_int) and (sheetdate_int <= today_int)
-            else:
-                if sheetdate_int <= today_int:
-                    output = True
-
-            if output:
-                rows += get_rows(sheetdate, sheetid)
 
-    return rows
+def find_set(sheetid, start, date, mirror=False, workers=1, wait=True):
+    return list(iter_rows(sheetid, start, date, mirror, workers, wait))
@@ -0,0 +1,116 @@
+import contextlib
+import queue
+import re
+import sqlite3
+import threading
+import config
+
+# columns sqlite-utils enable-fts indexes (see script/repopulate), and
+# the ones that name musicians
+FTS_COLUMNS = ['song', 'artist', 'vocal', 'guitar1', 'guitar2', 'bass', 'drums', 'keys']
+MUSICIAN_COLUMNS = ['vocal', 'guitar1', 'guitar2', 'bass', 'drums', 'keys']
+
+ORDERS = {
+    'rank': 'score, sets.date DESC, sets.songnum',
+    'date': 'sets.date DESC, sets.songnum',
+}
+
+
+class ConnectionPool:
+    '''
+    Read-only connections to the sets database, handed out one caller at
+    a time
+    '''
+    def __init__(self, path: str, size: int, timeout: float):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.lock = threading.Lock()
+        self.idle: queue.LifoQueue = queue.LifoQueue()
+
+    def _connect(self) -> sqlite3.Connection | None:
+        # a new connection if we're allowed one more
+        with self.lock:
+            if self.created >= self.size:
+                return None
+            self.created += 1
+        try:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        except sqlite3.Error:
+            # give the slot back, or enough failures leave none
+            with self.lock:
+                self.created -= 1
+            raise
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+            if conn is None:
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError('no sets database connection free') from None
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+
+_pool: ConnectionPool | None = None
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(config.SETS_DB_FILE, config.SETS_DB_POOL_SIZE, config.SETS_DB_POOL_TIMEOUT)
+    return _pool
+
+
+def prefix_terms(text: str) -> str:
+    # every word must appear, each as a prefix: 'hot chil' matches
+    # 'Red Hot Chili Peppers'
+    words = re.findall(r'[^\s"]+', text)
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+def fts_query(text: str, musicians: dict[str, str]) -> str:
+    parts = []
+    if terms := prefix_terms(text):
+        parts.append(f'({terms})')
+    for column, name in musicians.items():
+        if column not in MUSICIAN_COLUMNS:
+            raise ValueError(f'unknown musician column {column}')
+        if terms := prefix_terms(name):
+            parts.append(f'{column} : ({terms})')
+    return ' AND '.join(parts)
+
+
+def search(text: str = '', musicians: dict[str, str] | None = None,
+           limit: int = 20, offset: int = 0, order: str = 'rank') -> list[dict]:
+    '''
+    Return up to limit rows of the sets table, skipping offset, matching
+    every word of text (as prefixes, in any indexed column) and each
+    musicians column -> name filter, best bm25 match (or most recent, with
+    order='date') first
+    '''
+    query = fts_query(text, {k: v for k, v in (musicians or {}).items() if v})
+    if not query:
+        raise ValueError('nothing to search for')
+    if order not in ORDERS:
+        raise ValueError(f'order must be one of {", ".join(ORDERS)}')
+    with get_pool().connection() as conn:
+        results = conn.execute(
+            f'''SELECT sets.*, bm25(sets_fts) AS score
+                FROM sets_fts JOIN sets ON sets.rowid = sets_fts.rowid
+                WHERE sets_fts MATCH ?
+                ORDER BY {ORDERS[order]}
+                LIMIT ? OFFSET ?''',
+            (query, limit, offset),
+        )
+        return [dict(r) for r in results]
@@ -0,0 +1,61 @@
+import json
+import sqlite3
+import config
+
+# Local copy of the setlist index (ALL_SETLISTS_SHEETID A:B) and of the
+# raw header and song rows of each set sheet, kept up to date by
+# sync_sheets.py
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS setindex (
+    pos INTEGER PRIMARY KEY,
+    sheetdate TEXT NOT NULL,
+    sheetid TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheet (
+    sheetid TEXT PRIMARY KEY,
+    modified TEXT,
+    header TEXT NOT NULL,
+    songs TEXT NOT NULL
+);
+'''
+
+
+def connect(path: str = config.SHEET_MIRROR_FILE) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_index(conn: sqlite3.Connection) -> list[list[str]]:
+    # [sheetdate, sheetid] rows, in sheet order
+    return [list(r) for r in conn.execute('SELECT sheetdate, sheetid FROM setindex ORDER BY pos')]
+
+
+def put_index(conn: sqlite3.Connection, date_and_ids: list[list[str]]):
+    with conn:
+        conn.execute('DELETE FROM setindex')
+        conn.executemany(
+            'INSERT INTO setindex (pos, sheetdate, sheetid) VALUES (?, ?, ?)',
+            [(pos, d, i) for pos, (d, i) in enumerate(date_and_ids)],
+        )
+
+
+def get_sheet(conn: sqlite3.Connection, sheetid: str) -> tuple[list[str], list[list[str]]] | None:
+    row = conn.execute('SELECT header, songs FROM sheet WHERE sheetid = ?', (sheetid,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0]), json.loads(row[1])
+
+
+def put_sheet(conn: sqlite3.Connection, sheetid: str, modified: str | None,
+              header: list[str], songs: list[list[str]]):
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO sheet (sheetid, modified, header, songs) VALUES (?, ?, ?, ?)',
+            (sheetid, modified, json.dumps(header), json.dumps(songs)),
+        )
+
+
+def get_modified(conn: sqlite3.Connection) -> dict[str, str | None]:
+    return dict(conn.execute('SELECT sheetid, modified FROM sheet'))
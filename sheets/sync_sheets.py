@@ -0,0 +1,61 @@
+#!/home/dmick/src/jamtools/sheets/v/bin/python3
+
+import argparse
+import logging
+import sys
+
+import config
+import google_utils
+import set_utils
+import sheet_mirror
+
+log = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Update the local mirror of the setlist sheets, '
+                    'refetching only sheets Drive says have changed')
+    parser.add_argument('-f', '--full', action='store_true', help='refetch every sheet')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='fetch this many sheets concurrently')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    conn = sheet_mirror.connect()
+
+    date_and_ids = []
+    for idrow in set_utils.get_and_retry_on_rate_limit(config.ALL_SETLISTS_SHEETID, 'A:B'):
+        if len(idrow) == 0:
+            break
+        date_and_ids.append(idrow)
+    sheet_mirror.put_index(conn, date_and_ids)
+
+    sheetids = [sheetid for _, sheetid in date_and_ids]
+    modified = google_utils.get_modified_times(sheetids)
+    known = sheet_mirror.get_modified(conn)
+
+    changed = []
+    for sheetdate, sheetid in date_and_ids:
+        mtime = modified.get(sheetid)
+        # no modifiedTime means we can't tell, so always refetch
+        if not args.full and mtime is not None and known.get(sheetid) == mtime:
+            continue
+        log.info(f'fetching {sheetdate} {sheetid} (modified {mtime})')
+        changed.append(sheetid)
+
+    fetched = 0
+    for sheetid, (header, songs) in set_utils.iter_fetch_sheets(changed, args.jobs):
+        sheet_mirror.put_sheet(conn, sheetid, modified.get(sheetid), header, songs)
+        fetched += 1
+
+    print(f'{len(date_and_ids)} sets, {fetched} sheets fetched', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())